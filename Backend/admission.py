@@ -0,0 +1,282 @@
+import asyncio
+import json
+import math
+import os
+import re
+import time
+from collections import OrderedDict, deque
+from typing import Optional, Tuple
+from starlette.responses import JSONResponse
+from telemetry import admission_decisions, admission_queue_seconds
+from auth import decode_access_token
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Admission control settings (per worker process)
+# ADMISSION_ENABLED: rate-limit and cap the LLM-bound routes below
+# ADMISSION_<CLASS>_USER_RATE / _USER_BURST: per-user requests per minute, and how many may come at once
+# ADMISSION_<CLASS>_RATE / _BURST: the same for the route class as a whole (all users)
+# ADMISSION_<CLASS>_CONCURRENCY: requests of the class handled at once; the rest queue
+# ADMISSION_<CLASS>_QUEUE_TARGET: longest expected queue wait (seconds) before new requests are shed
+# ADMISSION_MAX_TRACKED_USERS: per-user buckets kept before the least recently used is dropped
+# <CLASS> is GENERATE (plan generation and regeneration) or CHAT. Other routes are never limited.
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+ADMISSION_MAX_TRACKED_USERS = int(os.getenv("ADMISSION_MAX_TRACKED_USERS", "10000"))
+
+def _setting(route_class: str, name: str, default: float) -> float:
+    return float(os.getenv(f"ADMISSION_{route_class.upper()}_{name}", default))
+
+class RouteClass:
+    """POST routes matching pattern, and the limits they share"""
+
+    def __init__(self, name: str, pattern: str, user_rate: float, user_burst: float,
+                 rate: float, burst: float, concurrency: float, queue_target: float):
+        self.name = name
+        self.pattern = re.compile(pattern)
+        self.user_rate = _setting(name, "USER_RATE", user_rate) / 60
+        self.user_burst = _setting(name, "USER_BURST", user_burst)
+        self.rate = _setting(name, "RATE", rate) / 60
+        self.burst = _setting(name, "BURST", burst)
+        self.concurrency = int(_setting(name, "CONCURRENCY", concurrency))
+        self.queue_target = _setting(name, "QUEUE_TARGET", queue_target)
+
+ROUTE_CLASSES = [
+    RouteClass(
+        "generate",
+        r"^/(diet|exercise)/(generate(/stream)?|(?P<user_id>\d+)/[^/]+(/[^/]+)?/regenerate)$",
+        user_rate=6, user_burst=3, rate=120, burst=30, concurrency=8, queue_target=10,
+    ),
+    RouteClass(
+        "chat",
+        r"^/chat/(stream)?$",
+        user_rate=30, user_burst=10, rate=600, burst=100, concurrency=32, queue_target=5,
+    ),
+]
+
+class TokenBucket:
+    """rate tokens per second, holding at most capacity"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait(self) -> float:
+        """Seconds until a token is available (0 if one is now)"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate else math.inf
+
+    def take(self):
+        self.tokens -= 1
+
+class Shed(Exception):
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+
+class ConcurrencyLimiter:
+    """At most limit requests at once; the rest wait in FIFO order
+
+    A request is shed up front when the expected wait (queue length times the
+    average service time, spread over the slots) exceeds queue_target, and
+    while waiting once it has waited queue_target seconds.
+    """
+
+    def __init__(self, limit: int, queue_target: float):
+        self.limit = limit
+        self.queue_target = queue_target
+        self.in_flight = 0
+        self.service_seconds: Optional[float] = None  # moving average
+        self._waiters = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def expected_wait(self) -> float:
+        if self.in_flight < self.limit:
+            return 0.0
+        return (len(self._waiters) + 1) / self.limit * (self.service_seconds or self.queue_target)
+
+    async def acquire(self):
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+        expected = self.expected_wait()
+        if expected > self.queue_target:
+            raise Shed(expected)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout=self.queue_target)
+        except asyncio.TimeoutError:
+            raise Shed(self.expected_wait() or self.queue_target)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._hand_over()  # a slot was passed to us just as the client went away
+            raise
+
+    def _hand_over(self):
+        """Pass a finished request's slot to the next live waiter, or free it"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def release(self, seconds: float):
+        average = self.service_seconds
+        self.service_seconds = seconds if average is None else 0.8 * average + 0.2 * seconds
+        self._hand_over()
+
+class AdmissionController:
+    """Per-user and per-class token buckets plus a concurrency limiter per class"""
+
+    def __init__(self, route_classes=ROUTE_CLASSES, max_users: int = ADMISSION_MAX_TRACKED_USERS):
+        self.route_classes = route_classes
+        self.max_users = max_users
+        self._class_buckets = {rc.name: TokenBucket(rc.rate, rc.burst) for rc in route_classes}
+        self._user_buckets: "OrderedDict[Tuple[str, str], TokenBucket]" = OrderedDict()
+        self.limiters = {rc.name: ConcurrencyLimiter(rc.concurrency, rc.queue_target) for rc in route_classes}
+
+    def classify(self, method: str, path: str) -> Optional[Tuple[RouteClass, Optional[str]]]:
+        """(route class, user id from the path if it has one), or None for unlimited routes"""
+        if method != "POST":
+            return None
+        for route_class in self.route_classes:
+            match = route_class.pattern.match(path)
+            if match:
+                return route_class, match.groupdict().get("user_id")
+        return None
+
+    def _user_bucket(self, route_class: RouteClass, user: str) -> TokenBucket:
+        key = (route_class.name, user)
+        bucket = self._user_buckets.get(key)
+        if bucket is None:
+            bucket = self._user_buckets[key] = TokenBucket(route_class.user_rate, route_class.user_burst)
+            while len(self._user_buckets) > self.max_users:
+                self._user_buckets.popitem(last=False)  # most likely refilled, so as good as new
+        self._user_buckets.move_to_end(key)
+        return bucket
+
+    def rate_limit(self, route_class: RouteClass, user: str) -> float:
+        """Take a token from both the user's and the class's bucket; else seconds to wait"""
+        buckets = [self._user_bucket(route_class, user), self._class_buckets[route_class.name]]
+        wait = max(bucket.wait() for bucket in buckets)
+        if not wait:
+            for bucket in buckets:
+                bucket.take()
+        return wait
+
+    def status(self) -> dict:
+        return {
+            rc.name: {
+                "in_flight": self.limiters[rc.name].in_flight,
+                "queued": self.limiters[rc.name].queued,
+                "limit": rc.concurrency,
+                "expected_wait": round(self.limiters[rc.name].expected_wait(), 3),
+                "service_seconds": self.limiters[rc.name].service_seconds,
+            }
+            for rc in self.route_classes
+        }
+
+admission = AdmissionController()
+
+async def _read_body(receive) -> Tuple[bytes, list]:
+    """The whole request body, plus the messages to replay to the app"""
+    messages, body = [], b""
+    while True:
+        message = await receive()
+        messages.append(message)
+        if message["type"] != "http.request":
+            break
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            break
+    return body, messages
+
+def _token_user(scope) -> Optional[str]:
+    """user_id from a valid bearer token (signature and expiry only; the route does the full check)"""
+    for name, value in scope.get("headers", []):
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            payload = decode_access_token(token) if scheme.lower() == "bearer" else None
+            if payload and "user_id" in payload:
+                return str(payload["user_id"])
+    return None
+
+def _body_user(body: bytes) -> Optional[str]:
+    try:
+        value = json.loads(body)
+    except ValueError:
+        return None
+    user_id = value.get("user_id") if isinstance(value, dict) else None
+    return str(user_id) if user_id is not None else None
+
+def _rejection(status: int, detail: str, retry_after: float) -> JSONResponse:
+    return JSONResponse({"detail": detail}, status_code=status,
+                        headers={"Retry-After": str(max(math.ceil(retry_after), 1))})
+
+class AdmissionMiddleware:
+    """ASGI middleware: 429 over a rate limit, 503 when a class's queue is too long; Retry-After on both
+
+    Users are identified by their bearer token, else the user_id in the path
+    or JSON body (the field the plan routes take), else the client address.
+    """
+
+    def __init__(self, app, controller: AdmissionController = admission):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        route = self.controller.classify(scope.get("method"), scope.get("path", "")) if scope["type"] == "http" else None
+        if not ADMISSION_ENABLED or route is None:
+            await self.app(scope, receive, send)
+            return
+        route_class, user = route
+        user = _token_user(scope) or user
+
+        if user is None:
+            body, messages = await _read_body(receive)
+            user = _body_user(body)
+            replay = iter(messages)
+
+            async def receive_replayed():
+                return next(replay, None) or await receive()
+            app_receive = receive_replayed
+        else:
+            app_receive = receive
+        if user is None:
+            client = scope.get("client")
+            user = f"client:{client[0]}" if client else "anonymous"
+
+        wait = self.controller.rate_limit(route_class, user)
+        if wait:
+            admission_decisions.inc(route_class=route_class.name, outcome="rate_limited")
+            await _rejection(429, "Too many requests", wait)(scope, receive, send)
+            return
+
+        limiter = self.controller.limiters[route_class.name]
+        queued_at = time.perf_counter()
+        try:
+            await limiter.acquire()
+        except Shed as e:
+            admission_decisions.inc(route_class=route_class.name, outcome="shed")
+            await _rejection(503, "Server busy, try again shortly", e.retry_after)(scope, receive, send)
+            return
+        admission_queue_seconds.observe(time.perf_counter() - queued_at, route_class=route_class.name)
+        admission_decisions.inc(route_class=route_class.name, outcome="admitted")
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, app_receive, send)
+        finally:
+            limiter.release(time.perf_counter() - started)
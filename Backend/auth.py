@@ -1,34 +1,117 @@
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+from fastapi import HTTPException
+from typing import Optional, Tuple
+import os
+import threading
+import time
+import uuid
+from dotenv import load_dotenv
+
+load_dotenv()
 
 # Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# BCRYPT_ROUNDS: bcrypt cost; hashes with any other cost are upgraded on the next login
+# PASSWORD_HASH_WORKERS: dedicated threads for bcrypt (it releases the GIL)
+# PASSWORD_HASH_MAX_PENDING: hashing jobs allowed running or queued before new ones get a 503
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "16"))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+_hash_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+_hash_pending = 0
+_hash_lock = threading.Lock()
 
-def password_hash(password: str) -> str:
+async def _run_password_job(fn, *args):
+    """Run fn on the bcrypt pool, rejecting immediately when too many jobs are waiting"""
+    global _hash_pending
+    with _hash_lock:
+        if _hash_pending >= PASSWORD_HASH_MAX_PENDING:
+            raise HTTPException(
+                status_code=503,
+                detail="Too many sign-in attempts in progress, please retry shortly",
+                headers={"Retry-After": "1"}
+            )
+        _hash_pending += 1
+    try:
+        return await asyncio.wrap_future(_hash_pool.submit(fn, *args))
+    finally:
+        with _hash_lock:
+            _hash_pending -= 1
+
+def _truncate(password: str) -> str:
     # bcrypt has a max length of 72 bytes
     while len(password.encode("utf-8")) > 72:
         password = password[:-1]
-    return pwd_context.hash(password)
+    return password
+
+async def password_hash(password: str) -> str:
+    return await _run_password_job(pwd_context.hash, _truncate(password))
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await _run_password_job(pwd_context.verify, plain_password, hashed_password)
+
+async def verify_and_update_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """Verify a password; also return a new hash when the stored one uses an outdated cost"""
+    return await _run_password_job(pwd_context.verify_and_update, plain_password, hashed_password)
 
 # JWT settings
-SECRET_KEY = "offline-secret-key"  # replace with a secure secret in production
+# JWT_SECRET_KEY: signing key for access tokens; required, and must stay private since a token's
+#   signature is all that is checked (e.g. python -c "import secrets; print(secrets.token_hex(32))")
+SECRET_KEY = os.getenv("JWT_SECRET_KEY")
+if not SECRET_KEY:
+    raise ValueError("❌ JWT_SECRET_KEY environment variable is not set.")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
 
 def create_access_token(data: dict, expires_delta: timedelta = None) -> str:
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 def decode_access_token(token: str):
+    """The payload of a token create_access_token issued, or None
+
+    exp, jti, user_id and ver are required: tokens without them were not made
+    by login and could never be revoked.
+    """
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM],
+                             options={"require_exp": True, "require_jti": True})
     except JWTError:
         return None
+    if not isinstance(payload.get("user_id"), int) or not isinstance(payload.get("ver"), int):
+        return None
+    return payload
+
+# Revoked token IDs (jti -> exp timestamp), checked in memory on every request
+_revoked = {}
+_revoked_lock = threading.Lock()
+
+def revoke_token(payload: dict):
+    """Deny a decoded token until it would have expired anyway"""
+    jti = payload.get("jti")
+    if not jti:
+        return
+    now = time.time()
+    with _revoked_lock:
+        _revoked[jti] = payload.get("exp", now + ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+        for expired in [key for key, exp in _revoked.items() if exp < now]:
+            del _revoked[expired]
+
+def is_revoked(payload: dict) -> bool:
+    jti = payload.get("jti")
+    return bool(jti) and jti in _revoked
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import random
+from types import SimpleNamespace
+from typing import Dict, Optional
+from google.api_core.exceptions import ServiceUnavailable
+import llm
+from llm import LLMClient
+from structured import list_schema, response_schema, week_schema
+from routers.diet_router import DayPlan, MealItem
+from routers.exercise_router import ExerciseDayPlan, ExerciseItem
+
+CHAT_ANSWER = ("- Rest and drink plenty of fluids\n"
+               "- Over-the-counter pain relief can help with mild symptoms\n"
+               "- See a doctor if symptoms last more than a few days or get worse\n")
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1 if text else 0
+
+def fill_schema(schema: dict, rng: random.Random, name: str = "item"):
+    """A random value matching a response_schema (two items per array, unique-ish names)"""
+    kind = schema["type"]
+    if kind == "object":
+        return {key: fill_schema(value, rng, key) for key, value in schema["properties"].items()}
+    if kind == "array":
+        return [fill_schema(schema["items"], rng, name) for _ in range(2)]
+    if kind == "string":
+        return f"{name.replace('_', ' ').title()} {rng.randint(1, 9999)}"
+    if kind == "integer":
+        return rng.randint(1, 60)
+    if kind == "number":
+        return round(rng.uniform(1, 500), 1)
+    return True
+
+def schema_for_prompt(prompt: str) -> Optional[dict]:
+    """Guess the expected JSON shape of a plain (schema-less) plan prompt"""
+    if "Return ONLY valid JSON" not in prompt:
+        return None
+    exercise = "exercise" in prompt.lower()
+    if "Monday to Sunday" in prompt:
+        return week_schema(ExerciseDayPlan if exercise else DayPlan)
+    if "exact format:\n        [" in prompt:
+        return list_schema(ExerciseItem if exercise else MealItem)
+    return response_schema(ExerciseDayPlan if exercise else DayPlan)
+
+class FakeResponse:
+    def __init__(self, text: str, prompt_tokens: int):
+        self.text = text
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens, candidates_token_count=estimate_tokens(text)
+        )
+
+class FakeStream:
+    """Async iterator of response chunks, released at the model's token rate"""
+
+    def __init__(self, model: "FakeGeminiModel", text: str, chunk_chars: int = 32):
+        self.model = model
+        self.chunks = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)]
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            await asyncio.sleep(self.model.generation_seconds(chunk))
+            yield SimpleNamespace(text=chunk)
+
+class FakeGeminiModel:
+    """Stand-in for genai.GenerativeModel with injected latency, token rate and failures
+
+    latency: seconds before the first token, varied by +/- jitter (a fraction)
+    tokens_per_second: response generation rate, 0 for instant responses
+    failure_rate: share of calls that raise ServiceUnavailable after the latency
+    hang_rate / hang_seconds: share of calls that stall, as a stuck provider would
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        latency: float = 0.5,
+        jitter: float = 0.2,
+        tokens_per_second: float = 0,
+        failure_rate: float = 0.0,
+        hang_rate: float = 0.0,
+        hang_seconds: float = 120.0,
+        seed: Optional[int] = None,
+    ):
+        self.model_name = model_name
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.failure_rate = failure_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.failures = 0
+
+    def generation_seconds(self, text: str) -> float:
+        return estimate_tokens(text) / self.tokens_per_second if self.tokens_per_second else 0.0
+
+    def answer(self, prompt: str, generation_config: Optional[dict]) -> str:
+        schema = (generation_config or {}).get("response_schema") or schema_for_prompt(prompt)
+        if schema is None:
+            return CHAT_ANSWER
+        return json.dumps(fill_schema(schema, self.rng))
+
+    async def _first_token(self):
+        """Wait out the latency, then fail or stall if this call drew an injected fault"""
+        self.calls += 1
+        await asyncio.sleep(max(self.latency * (1 + self.rng.uniform(-self.jitter, self.jitter)), 0))
+        draw = self.rng.random()
+        if draw < self.failure_rate:
+            self.failures += 1
+            raise ServiceUnavailable("injected failure")
+        if draw < self.failure_rate + self.hang_rate:
+            await asyncio.sleep(self.hang_seconds)
+
+    async def generate_content_async(self, prompt, stream: bool = False, generation_config: Optional[dict] = None, **kwargs):
+        await self._first_token()
+        text = self.answer(prompt, generation_config)
+        if stream:
+            return FakeStream(self, text)
+        await asyncio.sleep(self.generation_seconds(text))
+        return FakeResponse(text, estimate_tokens(prompt))
+
+class FakeLLMClient(LLMClient):
+    """LLMClient whose models are FakeGeminiModels; per-model options override the defaults"""
+
+    def __init__(self, model_options: Optional[Dict[str, dict]] = None, **defaults):
+        super().__init__("bench")
+        self.defaults = defaults
+        self.model_options = model_options or {}
+
+    def get_model(self, model_name: str = None):
+        model_name = model_name or self.model_name
+        model = self._models.get(model_name)
+        if model is None:
+            model = FakeGeminiModel(model_name, **{**self.defaults, **self.model_options.get(model_name, {})})
+            self._models[model_name] = model
+        return model
+
+    @property
+    def calls(self) -> int:
+        return sum(model.calls for model in self._models.values())
+
+    @property
+    def failures(self) -> int:
+        return sum(model.failures for model in self._models.values())
+
+def install(client: FakeLLMClient) -> FakeLLMClient:
+    """Make get_llm() (routers, plan pool) return client instead of the Gemini client"""
+    llm._client = client
+    return client
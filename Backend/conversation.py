@@ -0,0 +1,174 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import List, Tuple
+from database import AsyncSessionLocal
+from models import ChatSession
+from telemetry import get_logger
+from resilience import llm_deadline
+from dotenv import load_dotenv
+
+load_dotenv()
+
+log = get_logger("conversation")
+
+# Chat memory settings
+# CHAT_HISTORY_TOKENS: budget for recent turns kept verbatim in the prompt; when it is
+#   exceeded the oldest turns are folded into the rolling summary until half of it is left
+# CHAT_SUMMARY_TOKENS: budget for the rolling summary itself
+# CHAT_SESSION_IDLE_SECONDS: idle sessions are dropped from memory (they stay in the DB)
+# CHAT_MAX_SESSIONS: sessions held in memory per worker before the least recently used goes
+CHAT_HISTORY_TOKENS = int(os.getenv("CHAT_HISTORY_TOKENS", "1200"))
+CHAT_SUMMARY_TOKENS = int(os.getenv("CHAT_SUMMARY_TOKENS", "250"))
+CHAT_SESSION_IDLE_SECONDS = float(os.getenv("CHAT_SESSION_IDLE_SECONDS", "1800"))
+CHAT_MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", "1000"))
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token) used for budgeting"""
+    return len(text) // 4 + 1
+
+def build_summary_prompt(summary: str, turns: List[dict]) -> str:
+    messages = "\n".join(f"{turn['role'].capitalize()}: {turn['text']}" for turn in turns)
+    return f"""Update the running summary of a conversation between a user and a medical assistant.
+
+Current summary: {summary if summary else 'None'}
+
+New messages:
+{messages}
+
+Return ONLY the updated summary in under {CHAT_SUMMARY_TOKENS * 3 // 4} words. Keep health details
+the user shared (conditions, symptoms, allergies, medications, goals) and drop small talk."""
+
+class Conversation:
+    """One user's chat session: a rolling summary plus the most recent turns"""
+
+    def __init__(self, user_id: int, session_id: str, summary: str = "", turns: List[dict] = None):
+        self.user_id = user_id
+        self.session_id = session_id
+        self.summary = summary
+        self.turns = list(turns or [])
+        self.last_used = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    @property
+    def empty(self) -> bool:
+        return not self.summary and not self.turns
+
+    def history_tokens(self) -> int:
+        return sum(estimate_tokens(turn["text"]) for turn in self.turns)
+
+    def context(self) -> str:
+        """Summary and recent turns formatted for the prompt ("" for a new conversation)"""
+        parts = []
+        if self.summary:
+            parts.append(f"Summary of the earlier conversation: {self.summary}")
+        if self.turns:
+            parts.append("Recent messages:\n" + "\n".join(
+                f"{turn['role'].capitalize()}: {turn['text']}" for turn in self.turns
+            ))
+        return "\n\n".join(parts)
+
+    def add_exchange(self, message: str, answer: str):
+        self.turns = self.turns + [{"role": "user", "text": message}, {"role": "assistant", "text": answer}]
+
+    def needs_compaction(self) -> bool:
+        return self.history_tokens() > CHAT_HISTORY_TOKENS
+
+    async def compact(self, llm):
+        """Fold the oldest turns into the summary until the history is back under half its budget"""
+        keep = list(self.turns)
+        folded = []
+        while keep and sum(estimate_tokens(turn["text"]) for turn in keep) > CHAT_HISTORY_TOKENS // 2:
+            folded.append(keep.pop(0))
+        if not folded:
+            return
+        try:
+            response = await llm.generate(build_summary_prompt(self.summary, folded))
+            summary = response.text.strip()
+        except Exception as e:
+            # Without a summary the turns are still dropped, so the prompt stays bounded
+            log.warning("Chat summary failed", extra={"user_id": self.user_id, "error": str(e)})
+            summary = self.summary
+        self.summary = summary[:CHAT_SUMMARY_TOKENS * 4]
+        self.turns = keep
+
+class ConversationStore:
+    """Sessions in memory by (user_id, session_id), written through to chat_sessions"""
+
+    def __init__(self, max_sessions: int = CHAT_MAX_SESSIONS, idle_seconds: float = CHAT_SESSION_IDLE_SECONDS):
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self._sessions: "OrderedDict[Tuple[int, str], Conversation]" = OrderedDict()
+        self._tasks = set()
+
+    def _evict(self):
+        """Drop idle sessions, then the least recently used ones above max_sessions"""
+        cutoff = time.monotonic() - self.idle_seconds
+        for key, conversation in list(self._sessions.items()):
+            if conversation.last_used >= cutoff:
+                break  # ordered by last use, so everything after is newer
+            if not conversation.lock.locked():
+                del self._sessions[key]
+        while len(self._sessions) > self.max_sessions:
+            key, conversation = next(iter(self._sessions.items()))
+            if conversation.lock.locked():
+                break
+            del self._sessions[key]
+
+    async def get(self, user_id: int, session_id: str) -> Conversation:
+        key = (user_id, session_id)
+        conversation = self._sessions.get(key)
+        if conversation is None:
+            async with AsyncSessionLocal() as db:
+                row = await db.get(ChatSession, key)
+            conversation = self._sessions.get(key)  # another request may have loaded it meanwhile
+            if conversation is None:
+                conversation = (Conversation(user_id, session_id, row.summary, row.turns) if row
+                                else Conversation(user_id, session_id))
+                self._sessions[key] = conversation
+        conversation.last_used = time.monotonic()
+        self._sessions.move_to_end(key)
+        self._evict()
+        return conversation
+
+    async def save(self, conversation: Conversation):
+        async with AsyncSessionLocal() as db:
+            await db.merge(ChatSession(
+                user_id=conversation.user_id,
+                session_id=conversation.session_id,
+                summary=conversation.summary,
+                turns=conversation.turns
+            ))
+            await db.commit()
+
+    async def record(self, conversation: Conversation, message: str, answer: str, llm):
+        """Append and persist an exchange; call with conversation.lock held
+
+        Compaction runs after the reply has gone out. It takes the lock, so the
+        session's next message waits for it and still gets a bounded prompt.
+        """
+        conversation.add_exchange(message, answer)
+        await self.save(conversation)
+        if conversation.needs_compaction():
+            task = asyncio.create_task(self._compact(conversation, llm))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _compact(self, conversation: Conversation, llm):
+        # The task inherits the finished request's deadline; it gets its own budget instead
+        with llm_deadline("background"):
+            async with conversation.lock:
+                if conversation.needs_compaction():
+                    await conversation.compact(llm)
+                    await self.save(conversation)
+
+    async def clear(self, user_id: int, session_id: str):
+        self._sessions.pop((user_id, session_id), None)
+        async with AsyncSessionLocal() as db:
+            row = await db.get(ChatSession, (user_id, session_id))
+            if row is not None:
+                await db.delete(row)
+                await db.commit()
+
+conversations = ConversationStore()
@@ -1,6 +1,10 @@
 import os
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from db_metrics import PoolMetrics, timed_pool
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -8,26 +12,97 @@ load_dotenv()
 DATABASE_URL = os.getenv("NEONURL")
 if not DATABASE_URL:
     raise ValueError("❌ NEONURL environment variable is not set.")
+# A sqlite:/// URL runs everything against a local file (used by the benchmarks in bench/)
+DATABASE_BACKEND = make_url(DATABASE_URL).get_backend_name()
 
 Base = declarative_base()
 
-# Create engine with connection pool settings for Neon
-# pre_ping: Check connection health before using it
-# pool_recycle: Recycle connections after 300 seconds (5 min) to avoid stale connections
-# pool_pre_ping: Test connections before checkout
-engine = create_engine(
-    DATABASE_URL,
-    pool_pre_ping=True,  # Verify connections before using them
-    pool_recycle=300,    # Recycle connections every 5 minutes
-    pool_size=5,         # Connection pool size
-    max_overflow=10,     # Max connections beyond pool_size
-    connect_args={
+# Connection pool settings for Neon (all overridable from the environment)
+# DB_POOL_SIZE / DB_MAX_OVERFLOW: persistent connections and extra burst connections
+# DB_POOL_TIMEOUT: seconds to wait for a free connection before failing
+# DB_POOL_RECYCLE: recycle connections after this many seconds to avoid stale connections
+# DB_DISCONNECT_STRATEGY: "pre_ping" tests every checkout with a round trip;
+#   "optimistic" skips it and relies on recycle plus SQLAlchemy invalidating the
+#   pool when a disconnect error is seen (the request that hits it fails once)
+# DB_STATEMENT_TIMEOUT_MS: server-side statement_timeout, 0 leaves the server default
+#   (not supported through Neon's pgbouncer "-pooler" endpoint)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "300"))
+DB_DISCONNECT_STRATEGY = os.getenv("DB_DISCONNECT_STRATEGY", "pre_ping").lower()
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+
+def _pool_options() -> dict:
+    return {
+        "pool_pre_ping": DB_DISCONNECT_STRATEGY == "pre_ping",
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+    }
+
+sync_pool_metrics = PoolMetrics("sync")
+async_pool_metrics = PoolMetrics("async")
+
+if DATABASE_BACKEND == "sqlite":
+    _sync_connect_args = {"check_same_thread": False}
+else:
+    _sync_connect_args = {
         "connect_timeout": 10,  # Connection timeout in seconds
         "keepalives": 1,
         "keepalives_idle": 30,
         "keepalives_interval": 10,
         "keepalives_count": 5,
     }
+if DB_STATEMENT_TIMEOUT_MS and DATABASE_BACKEND == "postgresql":
+    _sync_connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+
+# Used by scripts and startup migrations; request handlers use async_engine below
+engine = create_engine(
+    DATABASE_URL,
+    poolclass=timed_pool(QueuePool, sync_pool_metrics),
+    connect_args=_sync_connect_args,
+    **_pool_options()
 )
+sync_pool_metrics.attach(engine)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def _async_url_and_args(url: str):
+    """Point the URL at asyncpg (aiosqlite for SQLite) and translate libpq-only query options"""
+    url = make_url(url)
+    connect_args = {}
+    if url.get_backend_name() == "sqlite":
+        url = url.set(drivername="sqlite+aiosqlite")
+    if url.get_backend_name() == "postgresql":
+        query = dict(url.query)
+        sslmode = query.pop("sslmode", None)
+        query.pop("channel_binding", None)  # asyncpg negotiates SCRAM itself
+        if sslmode and sslmode != "disable":
+            connect_args["ssl"] = "require" if sslmode in ("require", "prefer", "allow") else True
+        connect_args["timeout"] = 10  # Connection timeout in seconds
+        if DB_STATEMENT_TIMEOUT_MS:
+            connect_args["server_settings"] = {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}
+        url = url.set(drivername="postgresql+asyncpg", query=query)
+    return url, connect_args
+
+ASYNC_DATABASE_URL, _async_connect_args = _async_url_and_args(DATABASE_URL)
+
+# Async engine: DB waits no longer hold a threadpool thread each
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    poolclass=timed_pool(AsyncAdaptedQueuePool, async_pool_metrics),
+    connect_args=_async_connect_args,
+    **_pool_options()
+)
+async_pool_metrics.attach(async_engine.sync_engine)
+
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False, autoflush=False)
+
+# ----------------------
+# Dependency: get DB session
+# ----------------------
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
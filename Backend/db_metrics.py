@@ -0,0 +1,68 @@
+import threading
+import time
+from sqlalchemy import event
+
+# Upper bounds (seconds) for the checkout wait histogram
+WAIT_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+class PoolMetrics:
+    """Checkout wait histogram and connection churn counters for one engine's pool"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.pool = None
+        self.wait_buckets = [0] * (len(WAIT_BUCKETS) + 1)  # last slot is +Inf
+        self.wait_sum = 0.0
+        self.wait_count = 0
+        self.counters = {"connects": 0, "closes": 0, "invalidations": 0, "checkouts": 0, "checkins": 0}
+        self._lock = threading.Lock()
+
+    def observe_wait(self, seconds: float):
+        index = next((i for i, bound in enumerate(WAIT_BUCKETS) if seconds <= bound), len(WAIT_BUCKETS))
+        with self._lock:
+            self.wait_buckets[index] += 1
+            self.wait_sum += seconds
+            self.wait_count += 1
+
+    def _count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+
+    def attach(self, engine):
+        """Listen to pool events on a sync Engine (use async_engine.sync_engine for async ones)"""
+        self.pool = engine.pool
+        event.listen(engine, "connect", lambda *args: self._count("connects"))
+        event.listen(engine, "close", lambda *args: self._count("closes"))
+        event.listen(engine, "invalidate", lambda *args: self._count("invalidations"))
+        event.listen(engine, "checkout", lambda *args: self._count("checkouts"))
+        event.listen(engine, "checkin", lambda *args: self._count("checkins"))
+
+    def snapshot(self) -> dict:
+        pool = self.pool
+        with self._lock:
+            cumulative, buckets = 0, {}
+            for bound, count in zip(WAIT_BUCKETS + ["+Inf"], self.wait_buckets):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            return {
+                "size": pool.size() if pool is not None else 0,
+                "checked_out": pool.checkedout() if pool is not None else 0,
+                "idle": pool.checkedin() if pool is not None else 0,
+                "overflow": max(pool.overflow(), 0) if pool is not None else 0,
+                "checkout_wait_seconds": {"buckets": buckets, "sum": self.wait_sum, "count": self.wait_count},
+                **self.counters
+            }
+
+def timed_pool(pool_class, metrics: PoolMetrics):
+    """Subclass pool_class so the time spent waiting for a connection is recorded"""
+
+    class TimedPool(pool_class):
+        def _do_get(self):
+            start = time.perf_counter()
+            try:
+                return super()._do_get()
+            finally:
+                metrics.observe_wait(time.perf_counter() - start)
+
+    TimedPool.__name__ = f"Timed{pool_class.__name__}"
+    return TimedPool
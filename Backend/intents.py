@@ -0,0 +1,102 @@
+import difflib
+import os
+import re
+import threading
+from typing import Dict, List, Optional
+from cache import normalize
+
+# Intent routing settings
+# CHAT_FAQ_MATCH_CUTOFF: similarity (0-1) a message needs to a FAQ question to get its answer
+# CHAT_FAQ_WORD_CUTOFF: similarity each differing word needs to the question's word there (typos only)
+# CHAT_FAQ_MAX_LENGTH: longer messages are never treated as FAQs
+CHAT_FAQ_MATCH_CUTOFF = float(os.getenv("CHAT_FAQ_MATCH_CUTOFF", "0.9"))
+CHAT_FAQ_WORD_CUTOFF = float(os.getenv("CHAT_FAQ_WORD_CUTOFF", "0.75"))
+CHAT_FAQ_MAX_LENGTH = int(os.getenv("CHAT_FAQ_MAX_LENGTH", "60"))
+
+# Words a message may add to or leave out of a FAQ question and still match it
+FAQ_FILLER_WORDS = {"a", "the", "so", "just", "please", "pls", "really", "actually", "exactly", "again", "ok", "okay"}
+
+def same_words(message: str, question: str, word_cutoff: float = CHAT_FAQ_WORD_CUTOFF) -> bool:
+    """Whether message says question word for word, up to typos and filler words
+
+    Words are aligned in order; a replaced word must be a near spelling of the
+    one it replaces, and added or dropped words must be fillers. So "how can you
+    help me sleep" is not "how can you help me", nor "update my diet" "update my profile".
+    """
+    message_words, question_words = message.split(), question.split()
+    matcher = difflib.SequenceMatcher(None, message_words, question_words, autojunk=False)
+    for op, m1, m2, q1, q2 in matcher.get_opcodes():
+        if op == "equal":
+            continue
+        added, dropped = message_words[m1:m2], question_words[q1:q2]
+        if op == "replace" and len(added) == len(dropped):
+            if all(difflib.SequenceMatcher(None, a, b).ratio() >= word_cutoff for a, b in zip(added, dropped)):
+                continue
+        if not set(added + dropped) <= FAQ_FILLER_WORDS:
+            return False
+    return True
+
+class IntentRouter:
+    """Answer common chat intents locally before anything is sent to the LLM
+
+    Messages are checked against, in order: whole-message patterns (greetings,
+    thanks), the FAQ table (near-exact wording only, see same_words), then
+    keyword intents. Each intent's keywords are compiled into one regex, so a
+    check is a single scan of the message. route() returns None for messages
+    that need the LLM.
+    """
+
+    def __init__(self, faq_cutoff: float = CHAT_FAQ_MATCH_CUTOFF, faq_max_length: int = CHAT_FAQ_MAX_LENGTH):
+        self.faq_cutoff = faq_cutoff
+        self.faq_max_length = faq_max_length
+        self._patterns = []  # (intent, compiled regex, reply, extra)
+        self._keywords = []
+        self._faq: Dict[str, str] = {}  # normalized question -> intent
+        self._faq_answers: Dict[str, str] = {}  # intent -> answer
+        self._hits: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add_pattern(self, intent: str, pattern: str, reply: str, **extra):
+        """Intent for messages that match pattern in full (case-insensitive)"""
+        self._patterns.append((intent, re.compile(pattern, re.IGNORECASE), reply, extra))
+
+    def add_keywords(self, intent: str, keywords: List[str], reply: str, **extra):
+        """Intent for messages containing a word that starts with any of keywords"""
+        alternatives = "|".join(re.escape(keyword) for keyword in sorted(keywords, key=len, reverse=True))
+        self._keywords.append((intent, re.compile(rf"\b(?:{alternatives})", re.IGNORECASE), reply, extra))
+
+    def add_faq(self, intent: str, questions: List[str], answer: str):
+        for question in questions:
+            self._faq[normalize(question)] = intent
+        self._faq_answers[intent] = answer
+
+    def _count(self, intent: str):
+        with self._lock:
+            self._hits[intent] = self._hits.get(intent, 0) + 1
+
+    def route(self, message: str) -> Optional[dict]:
+        """{"intent", "response", ...extra} for a locally answered message, else None"""
+        for intent, pattern, reply, extra in self._patterns:
+            if pattern.fullmatch(message.strip()):
+                self._count(intent)
+                return {"intent": intent, "response": reply, **extra}
+
+        if len(message) <= self.faq_max_length:
+            text = normalize(message)
+            for question in difflib.get_close_matches(text, self._faq, n=3, cutoff=self.faq_cutoff):
+                if same_words(text, question):
+                    intent = self._faq[question]
+                    self._count(intent)
+                    return {"intent": intent, "response": self._faq_answers[intent]}
+
+        for intent, pattern, reply, extra in self._keywords:
+            if pattern.search(message):
+                self._count(intent)
+                return {"intent": intent, "response": reply, **extra}
+
+        self._count("llm")
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._hits)
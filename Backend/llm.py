@@ -0,0 +1,235 @@
+import asyncio
+import math
+import os
+import time
+import google.generativeai as genai
+from fastapi import HTTPException
+from telemetry import get_logger, llm_fallbacks, record_llm_call
+from resilience import (
+    LLM_FALLBACK_MODEL, LLM_HEDGE_PERCENTILE, LLM_RETRY_ATTEMPTS,
+    health, hedged, is_transient, remaining, remember_answer, stored_answer,
+)
+from dotenv import load_dotenv
+
+load_dotenv()
+
+log = get_logger("llm")
+
+GEMINI_API_KEY = os.getenv("GEMINIAPI")
+if not GEMINI_API_KEY:
+    log.warning("GEMINIAPI environment variable not set")
+
+# LLM call settings
+# LLM_MODEL_NAME: Gemini model used by all routers
+# LLM_TEMPERATURE: optional sampling temperature (provider default when unset)
+# LLM_MAX_CONCURRENCY: generations allowed in flight per worker process
+# LLM_TIMEOUT_SECONDS: per-call timeout before giving up on the provider
+LLM_MODEL_NAME = os.getenv("LLM_MODEL_NAME", "gemini-2.5-flash")
+LLM_TEMPERATURE = os.getenv("LLM_TEMPERATURE")
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+
+_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+def _estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1 if text else 0
+
+def _record(model, prompt, response, text: str, seconds: float, outcome: str):
+    """Report latency and token usage, estimating tokens when the response carries no usage data"""
+    usage = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(usage, "prompt_token_count", 0) or (_estimate_tokens(prompt) if isinstance(prompt, str) else 0)
+    response_tokens = getattr(usage, "candidates_token_count", 0) or _estimate_tokens(text)
+    record_llm_call(getattr(model, "model_name", "unknown"), seconds, outcome, prompt_tokens, response_tokens)
+
+async def generate_content(model, prompt, timeout: float = None, **kwargs):
+    """Run model.generate_content without blocking the event loop"""
+    async with _semaphore:
+        start = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(
+                model.generate_content_async(prompt, **kwargs),
+                timeout=timeout or LLM_TIMEOUT_SECONDS
+            )
+        except asyncio.TimeoutError:
+            _record(model, prompt, None, "", time.perf_counter() - start, "timeout")
+            raise HTTPException(status_code=504, detail="AI service timed out")
+        except Exception:
+            _record(model, prompt, None, "", time.perf_counter() - start, "error")
+            raise
+        try:
+            text = response.text
+        except ValueError:
+            text = ""  # blocked or empty candidates; the caller sees the same error on .text
+        _record(model, prompt, response, text, time.perf_counter() - start, "ok")
+        return response
+
+class LLMClient:
+    """Process-wide Gemini client: configures the SDK once and reuses model instances"""
+
+    def __init__(self, api_key: str, model_name: str = LLM_MODEL_NAME, generation_config: dict = None):
+        self.api_key = api_key
+        self.model_name = model_name
+        self.generation_config = generation_config or {}
+        self._models = {}
+        if api_key:
+            genai.configure(api_key=api_key)
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.api_key)
+
+    def get_model(self, model_name: str = None):
+        """Return the cached GenerativeModel for model_name, building it on first use"""
+        model_name = model_name or self.model_name
+        model = self._models.get(model_name)
+        if model is None:
+            model = genai.GenerativeModel(model_name, generation_config=self.generation_config or None)
+            self._models[model_name] = model
+        return model
+
+    def _models_to_try(self, model_name: str = None) -> list:
+        """Primary model (once plus retries), then the fallback model"""
+        primary = model_name or self.model_name
+        models = [primary] * (1 + LLM_RETRY_ATTEMPTS)
+        if LLM_FALLBACK_MODEL and LLM_FALLBACK_MODEL != primary:
+            models.append(LLM_FALLBACK_MODEL)
+        return models
+
+    async def _attempt(self, model_name: str, prompt, budget: float, **kwargs):
+        """One hedged call to model_name within budget seconds"""
+        model = self.get_model(model_name)
+        latency = health.latency(model_name)
+
+        async def call(timeout: float):
+            start = time.monotonic()
+            response = await generate_content(model, prompt, timeout, **kwargs)
+            latency.add(time.monotonic() - start)
+            return response
+
+        hedge_after = latency.percentile(LLM_HEDGE_PERCENTILE) if LLM_HEDGE_PERCENTILE else None
+        return await hedged(call, budget, hedge_after, model_name, can_hedge=lambda: not _semaphore.locked())
+
+    async def generate(self, prompt, model_name: str = None, timeout: float = None, **kwargs):
+        """Generate within the request's deadline (see resilience.py)
+
+        Transient failures are retried, slow calls hedged, and a failing or
+        open primary model falls over to LLM_FALLBACK_MODEL. When every model
+        fails, the last good answer to the same prompt is served if there is one.
+        """
+        deadline = time.monotonic() + min(remaining(), timeout or LLM_TIMEOUT_SECONDS)
+        primary = model_name or self.model_name
+        error = None
+        for attempt, name in enumerate(self._models_to_try(model_name)):
+            budget = deadline - time.monotonic()
+            breaker = health.breaker(name)
+            if budget <= 0:
+                error = asyncio.TimeoutError()
+                break
+            if not breaker.allow():
+                continue
+            if attempt and name == primary:
+                await asyncio.sleep(min(0.2 * attempt, budget / 2))  # back off before retrying the same model
+            try:
+                response = await self._attempt(name, prompt, deadline - time.monotonic(), **kwargs)
+            except Exception as e:
+                if not is_transient(e) and name == primary:
+                    breaker.record_success()  # the provider answered; the request itself was rejected
+                    raise
+                breaker.record_failure()
+                log.warning("LLM call failed", extra={"model": name, "error": repr(e)})
+                error = e
+                continue
+            except BaseException:
+                breaker.abandon()  # cancelled before an outcome was known
+                raise
+            breaker.record_success()
+            if name != primary:
+                llm_fallbacks.inc(kind="model", model=name)
+            remember_answer(prompt, kwargs, response)
+            return response
+
+        cached = stored_answer(prompt, kwargs)
+        if cached is not None:
+            llm_fallbacks.inc(kind="cache", model=primary)
+            return cached
+        raise unavailable(error)
+
+    async def stream(self, prompt, model_name: str = None, timeout: float = None, **kwargs):
+        """Yield response text chunks as the model produces them
+
+        The fallback model is only used if the primary fails before its first chunk.
+        """
+        timeout = timeout or LLM_TIMEOUT_SECONDS
+        deadline = time.monotonic() + min(remaining(), timeout)
+        error = None
+        for name in dict.fromkeys(self._models_to_try(model_name)):
+            breaker = health.breaker(name)
+            if deadline <= time.monotonic() or not breaker.allow():
+                continue
+            model = self.get_model(name)
+            async with _semaphore:
+                start = time.perf_counter()
+                response, parts, outcome = None, [], "error"
+                try:
+                    response = await asyncio.wait_for(
+                        model.generate_content_async(prompt, stream=True, **kwargs),
+                        timeout=deadline - time.monotonic()
+                    )
+                    chunks = response.__aiter__()
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(chunks.__anext__(), timeout=timeout)
+                        except StopAsyncIteration:
+                            break
+                        if chunk.text:
+                            parts.append(chunk.text)
+                            yield chunk.text
+                    outcome = "ok"
+                except asyncio.TimeoutError as e:
+                    outcome = "timeout"
+                    error = e
+                except Exception as e:
+                    if not is_transient(e):
+                        breaker.record_success()  # the provider answered; the request itself was rejected
+                        raise
+                    error = e
+                except BaseException:
+                    breaker.abandon()  # cancelled, or the client closed the stream (GeneratorExit)
+                    raise
+                finally:
+                    _record(model, prompt, response, "".join(parts), time.perf_counter() - start, outcome)
+            if outcome == "ok":
+                breaker.record_success()
+                return
+            breaker.record_failure()
+            if parts:
+                raise unavailable(error)  # part of the answer has been sent; too late to switch models
+            log.warning("LLM stream failed", extra={"model": name, "error": repr(error)})
+        raise unavailable(error)
+
+def unavailable(error: Exception = None) -> HTTPException:
+    """504 when the last attempt timed out, else 503 (with Retry-After while breakers are open)"""
+    if isinstance(error, asyncio.TimeoutError) or (isinstance(error, HTTPException) and error.status_code == 504):
+        return HTTPException(status_code=504, detail="AI service timed out")
+    retry_after = health.retry_after()
+    headers = {"Retry-After": str(math.ceil(retry_after))} if retry_after else None
+    return HTTPException(status_code=503, detail="AI service unavailable", headers=headers)
+
+def _default_generation_config() -> dict:
+    config = {}
+    if LLM_TEMPERATURE:
+        config["temperature"] = float(LLM_TEMPERATURE)
+    return config
+
+_client = None
+
+# ----------------------
+# Dependency: shared LLM client
+# ----------------------
+def get_llm() -> LLMClient:
+    global _client
+    if _client is None:
+        _client = LLMClient(GEMINI_API_KEY, generation_config=_default_generation_config())
+    if not _client.configured:
+        raise HTTPException(status_code=500, detail="Gemini API key not configured")
+    return _client
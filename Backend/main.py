@@ -1,18 +1,35 @@
 # backend/main.py
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from sqlalchemy import text
 from sqlalchemy.exc import SQLAlchemyError
-from database import engine 
+from database import engine, async_engine, async_pool_metrics, sync_pool_metrics
+from admission import AdmissionMiddleware, admission
+from telemetry import MetricsMiddleware, get_logger, instrument_engine, render_counters, render_metrics, render_pool_wait
+from cache import response_cache
+from migrate import run_migrations
+from llm import get_llm
+from structured import parse_stats
+from resilience import health as llm_health
+from singleflight import llm_flights
+from plan_pool import worker as plan_pool_worker
 from routers.auth_router import router as authrouter
-from routers.chat_router import router as chatrouter
+from routers.chat_router import router as chatrouter, intent_router
 from routers.diet_router import router as dietrouter
 from routers.exercise_router import router as exerciserouter
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI()
+log = get_logger("app")
+
+instrument_engine(engine, "sync")
+instrument_engine(async_engine.sync_engine, "async")
 
+app = FastAPI()
+# Added first so it runs inside MetricsMiddleware and rejected requests are still measured
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(authrouter)
 app.include_router(chatrouter)
@@ -20,14 +37,85 @@ app.include_router(dietrouter)
 app.include_router(exerciserouter)
 
 @app.on_event("startup")
-def test_db_connection():
+async def test_db_connection():
+    try:
+        async with async_engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+        log.info("Database connection successful")
+    except SQLAlchemyError as e:
+        log.error("Database connection failed", extra={"error": str(e)})
+
+@app.on_event("startup")
+def apply_migrations():
     try:
-        with engine.connect() as connection:
-            connection.execute(text("SELECT 1"))
-        print("✅ Neon PostgreSQL database connection successful!")
+        run_migrations()
     except SQLAlchemyError as e:
-        print(f"❌ Database connection failed: {e}")
+        log.error("Database migration failed", extra={"error": str(e)})
+
+@app.on_event("startup")
+async def start_plan_pool():
+    plan_pool_worker.start(get_llm)
+
+@app.on_event("shutdown")
+async def stop_plan_pool():
+    await plan_pool_worker.stop()
+
+@app.on_event("shutdown")
+async def close_db_pool():
+    await async_engine.dispose()
 
 @app.get("/")
 def read_root():
     return {"message": "Hello, MediNova with Neon PostgreSQL!"}
+
+@app.get("/cache/stats")
+def cache_stats():
+    """LLM response cache hit/miss counters"""
+    return response_cache.stats()
+
+@app.get("/plan-pool/status")
+async def plan_pool_status():
+    """Ready pre-generated plans per preference bucket"""
+    return await plan_pool_worker.status()
+
+@app.get("/db/pool")
+def db_pool_metrics():
+    """Connection pool occupancy, checkout wait histogram and churn counters"""
+    return {"async": async_pool_metrics.snapshot(), "sync": sync_pool_metrics.snapshot()}
+
+@app.get("/llm/parse-stats")
+def llm_parse_stats():
+    """Invalid JSON / invalid fragment counters and how they were recovered"""
+    return parse_stats.snapshot()
+
+@app.get("/llm/health")
+def llm_health_status():
+    """Circuit breaker state and hedging threshold per model"""
+    return llm_health.status()
+
+@app.get("/llm/coalescing")
+def llm_coalescing_stats():
+    """Generations started per namespace, and requests that joined one already in flight"""
+    return llm_flights.stats()
+
+@app.get("/admission/status")
+def admission_status():
+    """In-flight and queued requests per rate-limited route class"""
+    return admission.status()
+
+@app.get("/chat-intents/stats")
+def chat_intent_stats():
+    """Messages answered locally per intent; "llm" counts the ones sent to Gemini"""
+    return intent_router.stats()
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus text exposition: request/DB/LLM latency, tokens, pool waits, intents, parse failures"""
+    return PlainTextResponse(render_metrics([
+        render_pool_wait({"async": async_pool_metrics.snapshot(), "sync": sync_pool_metrics.snapshot()}),
+        render_counters("chat_intent_hits_total", "Chat messages by routed intent (llm = sent to Gemini)",
+                        {(("intent", intent),): hits for intent, hits in intent_router.stats().items()}),
+        render_counters("llm_parse_events_total", "Structured-output parse failures and recoveries",
+                        {(("kind", kind), ("event", event)): n
+                         for kind, counts in parse_stats.snapshot().items() for event, n in counts.items()}),
+    ]), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,75 @@
+# migrate.py
+from sqlalchemy import Integer, inspect, text
+from database import engine, Base
+from models import DAYS, MEAL_TYPES, EXERCISE_CATEGORIES
+import models
+
+def add_users_token_version(connection):
+    """users.token_version: revocation counter for stateless JWT verification"""
+    columns = [column["name"] for column in inspect(connection).get_columns("users")]
+    if "token_version" not in columns:
+        connection.execute(text("ALTER TABLE users ADD COLUMN token_version INTEGER NOT NULL DEFAULT 0"))
+
+def _code_column(connection, table: str, column: str, names: list) -> bool:
+    """Convert a free-form name column to the SMALLINT codes models.CodedName stores"""
+    columns = {c["name"]: c["type"] for c in inspect(connection).get_columns(table)}
+    if isinstance(columns[column], Integer):
+        return False
+    code = "CASE lower(trim({0})) {1} END".format(
+        column, " ".join(f"WHEN '{name.lower()}' THEN {i}" for i, name in enumerate(names))
+    )
+    # Rows with names outside the list could never be grouped by the API anyway
+    connection.execute(text(f"DELETE FROM {table} WHERE {code} IS NULL"))
+    connection.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE SMALLINT USING {code}"))
+    return True
+
+def code_plan_columns(connection):
+    """diet_plans/exercise_plans: day, meal_type and category as SMALLINT codes"""
+    if connection.dialect.name != "postgresql":
+        return  # other databases only get fresh tables from create_all
+    changed = [
+        _code_column(connection, "diet_plans", "day", DAYS),
+        _code_column(connection, "diet_plans", "meal_type", MEAL_TYPES),
+        _code_column(connection, "exercise_plans", "day", DAYS),
+        _code_column(connection, "exercise_plans", "category", EXERCISE_CATEGORIES),
+    ]
+    if any(changed):
+        # Stored documents may list rows dropped above; GET rebuilds them on demand
+        connection.execute(text("DELETE FROM plan_documents"))
+
+def add_plan_composite_indexes(connection):
+    """(user_id, day, meal_type/category) indexes replace the user_id-only ones"""
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_diet_plans_user_day_meal ON diet_plans (user_id, day, meal_type)"
+    ))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_exercise_plans_user_day_category ON exercise_plans (user_id, day, category)"
+    ))
+    connection.execute(text("DROP INDEX IF EXISTS ix_diet_plans_user_id"))
+    connection.execute(text("DROP INDEX IF EXISTS ix_exercise_plans_user_id"))
+
+def add_plan_documents_version(connection):
+    """plan_documents.version: replacement counter for optimistic concurrency"""
+    columns = [column["name"] for column in inspect(connection).get_columns("plan_documents")]
+    if "version" not in columns:
+        connection.execute(text("ALTER TABLE plan_documents ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+
+# Applied in order; every step must be safe to run again
+MIGRATIONS = [
+    add_users_token_version,
+    code_plan_columns,
+    add_plan_composite_indexes,
+    add_plan_documents_version,
+]
+
+def run_migrations():
+    """Create missing tables, then bring existing ones up to date with models.py"""
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        for migration in MIGRATIONS:
+            migration(connection)
+
+if __name__ == "__main__":
+    print("Running database migrations...")
+    run_migrations()
+    print("Migrations applied successfully!")
@@ -1,7 +1,44 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime
+from sqlalchemy import Column, Integer, SmallInteger, String, Float, DateTime, JSON, Index
+from sqlalchemy.orm import validates
+from sqlalchemy.types import TypeDecorator
 from datetime import datetime
 from database import Base  # Base from database.py
 
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+MEAL_TYPES = ["breakfast", "lunch", "dinner", "snacks"]
+EXERCISE_CATEGORIES = ["Cardio", "Strength", "Flexibility"]
+
+class CodedName(TypeDecorator):
+    """A name from a fixed list, stored as its SMALLINT position in that list"""
+    impl = SmallInteger
+    cache_ok = True
+
+    def __init__(self, names):
+        super().__init__()
+        self.names = tuple(names)
+        self._codes = {name.lower(): code for code, name in enumerate(self.names)}
+
+    def code(self, value: str) -> int:
+        try:
+            return self._codes[value.strip().lower()]
+        except KeyError:
+            raise ValueError(f"{value!r} is not one of: {', '.join(self.names)}")
+
+    def canonical(self, value: str) -> str:
+        return self.names[self.code(value)]
+
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, int):
+            return value
+        return self.code(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else self.names[value]
+
+DayName = CodedName(DAYS)
+MealTypeName = CodedName(MEAL_TYPES)
+ExerciseCategoryName = CodedName(EXERCISE_CATEGORIES)
+
 class User(Base):
     __tablename__ = "users"
 
@@ -10,6 +47,7 @@ class User(Base):
     email = Column(String, unique=True, index=True, nullable=False)
     password = Column(String, nullable=False)
     token = Column(String, nullable=True, default=None)  # Authentication token
+    token_version = Column(Integer, nullable=False, default=0, server_default="0")  # bumped on logout to revoke issued JWTs
     
     # Profile fields
     phone = Column(String, nullable=True)
@@ -25,9 +63,9 @@ class DietPlan(Base):
     __tablename__ = "diet_plans"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, nullable=False, index=True)
-    day = Column(String, nullable=False)  # Monday, Tuesday, etc.
-    meal_type = Column(String, nullable=False)  # breakfast, lunch, dinner, snacks
+    user_id = Column(Integer, nullable=False)
+    day = Column(DayName, nullable=False)  # Monday, Tuesday, etc.
+    meal_type = Column(MealTypeName, nullable=False)  # breakfast, lunch, dinner, snacks
     meal_name = Column(String, nullable=False)
     calories = Column(Float, nullable=False)
     protein = Column(Float, nullable=False)
@@ -35,16 +73,59 @@ class DietPlan(Base):
     fat = Column(Float, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    @validates("day", "meal_type")
+    def _canonical_name(self, key, value):
+        return DietPlan.__table__.c[key].type.canonical(value)
+
+    # Also serves user_id-only lookups, so user_id has no index of its own
+    __table_args__ = (Index("ix_diet_plans_user_day_meal", "user_id", "day", "meal_type"),)
+
 class ExercisePlan(Base):
     __tablename__ = "exercise_plans"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, nullable=False, index=True)
-    day = Column(String, nullable=False)  # Monday, Tuesday, etc.
-    category = Column(String, nullable=False)  # Cardio, Strength, Flexibility
+    user_id = Column(Integer, nullable=False)
+    day = Column(DayName, nullable=False)  # Monday, Tuesday, etc.
+    category = Column(ExerciseCategoryName, nullable=False)  # Cardio, Strength, Flexibility
     exercise_name = Column(String, nullable=False)
     duration = Column(Integer, nullable=False)  # minutes
     calories = Column(Float, nullable=False)
     sets = Column(Integer, nullable=True)  # for strength training
     reps = Column(Integer, nullable=True)  # for strength training
     created_at = Column(DateTime, default=datetime.utcnow)
+
+    @validates("day", "category")
+    def _canonical_name(self, key, value):
+        return ExercisePlan.__table__.c[key].type.canonical(value)
+
+    __table_args__ = (Index("ix_exercise_plans_user_day_category", "user_id", "day", "category"),)
+
+class PlanPool(Base):
+    __tablename__ = "plan_pool"
+
+    id = Column(Integer, primary_key=True, index=True)
+    plan_type = Column(String, nullable=False)  # diet, exercise
+    bucket = Column(String, nullable=False)  # normalized preferences string
+    plan = Column(JSON, nullable=False)  # validated weekly plan, same shape as /generate returns
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (Index("ix_plan_pool_type_bucket", "plan_type", "bucket"),)
+
+class PlanDocument(Base):
+    __tablename__ = "plan_documents"
+
+    user_id = Column(Integer, primary_key=True)
+    plan_type = Column(String, primary_key=True)  # diet, exercise
+    document = Column(JSON, nullable=False)  # plan grouped exactly as GET /diet or /exercise returns it
+    etag = Column(String, nullable=False)
+    version = Column(Integer, nullable=False, default=1, server_default="1")  # bumped on every write
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ChatSession(Base):
+    __tablename__ = "chat_sessions"
+
+    user_id = Column(Integer, primary_key=True)
+    session_id = Column(String, primary_key=True)
+    summary = Column(String, nullable=False, default="")  # rolling summary of compacted turns
+    turns = Column(JSON, nullable=False, default=list)  # recent turns kept verbatim: [{"role", "text"}]
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -0,0 +1,92 @@
+import hashlib
+import json
+from typing import Awaitable, Callable, Optional
+from fastapi import HTTPException, Response
+from fastapi.responses import JSONResponse
+from sqlalchemy import delete
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal
+from models import CodedName, PlanDocument
+
+# Each user's diet/exercise plan is also stored pre-grouped in plan_documents,
+# rewritten in the same transaction as every change to the row tables, so
+# GET /diet/{id} and GET /exercise/{id} are a single primary-key read.
+
+def compute_etag(document: dict) -> str:
+    canonical = json.dumps(document, sort_keys=True, separators=(",", ":"))
+    return '"' + hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32] + '"'
+
+async def write_document(db: AsyncSession, user_id: int, plan_type: str, document: dict) -> Optional[PlanDocument]:
+    """Store (or remove, when empty) the grouped plan and bump its version; the caller commits"""
+    if not document:
+        await db.execute(
+            delete(PlanDocument).where(PlanDocument.user_id == user_id, PlanDocument.plan_type == plan_type)
+        )
+        return None
+    doc = await get_document(db, user_id, plan_type)
+    if doc is None:
+        doc = PlanDocument(user_id=user_id, plan_type=plan_type, version=0)
+        db.add(doc)
+    doc.document = document
+    doc.etag = compute_etag(document)
+    doc.version += 1
+    return doc
+
+async def get_document(db: AsyncSession, user_id: int, plan_type: str) -> Optional[PlanDocument]:
+    return await db.get(PlanDocument, (user_id, plan_type))
+
+async def backfill_document(
+    db: AsyncSession,
+    user_id: int,
+    plan_type: str,
+    refresh_document: Callable[[AsyncSession, int], Awaitable[Optional[PlanDocument]]],
+) -> Optional[PlanDocument]:
+    """Build and store the document of a plan saved before documents existed (None if no plan)
+
+    Concurrent first reads race to insert it; the losers' inserts conflict on
+    the primary key and they return the stored document instead.
+    """
+    doc = await refresh_document(db, user_id)
+    if doc is None:
+        return None
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        doc = await get_document(db, user_id, plan_type)
+    return doc
+
+async def read_document(user_id: int, plan_type: str) -> dict:
+    """The grouped plan ({} if none), read in its own short session
+
+    For handlers that call the LLM next: the connection goes back to the pool
+    before the call instead of idling in a transaction for its whole duration.
+    """
+    async with AsyncSessionLocal() as db:
+        doc = await get_document(db, user_id, plan_type)
+        return doc.document if doc is not None else {}
+
+def document_response(key: str, doc: PlanDocument, if_none_match: Optional[str]) -> Response:
+    """200 with the document and its ETag, or 304 when the client already has it"""
+    headers = {"ETag": doc.etag, "Cache-Control": "no-cache"}
+    if if_none_match and doc.etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse({"success": True, key: doc.document}, headers=headers)
+
+def slot_name(names: CodedName, value: str) -> str:
+    """Canonical day / meal type / category from a path segment, 404 if unknown"""
+    try:
+        return names.canonical(value)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+def summarize_week(document: dict, name_key: str, skip_day: Optional[str] = None) -> str:
+    """Item names per day and slot: compact week context for single-day/slot prompts"""
+    lines = []
+    for day, slots in document.items():
+        if day == skip_day:
+            continue
+        parts = [f"{slot}: {', '.join(item[name_key] for item in items)}" for slot, items in slots.items() if items]
+        lines.append(f"{day} - {'; '.join(parts)}")
+    return "\n".join(lines) if lines else "None"
@@ -0,0 +1,144 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, Dict, Optional
+from fastapi import HTTPException
+from sqlalchemy import func, select
+from database import AsyncSessionLocal
+from models import PlanPool
+from cache import normalize
+from resilience import llm_deadline
+from telemetry import get_logger
+from dotenv import load_dotenv
+
+load_dotenv()
+
+log = get_logger("plan_pool")
+
+# Plan pool settings
+# PLAN_POOL_ENABLED: run the background pre-generation worker
+# PLAN_POOL_DEPTH: ready plans kept per preference bucket
+# PLAN_POOL_REFILL_INTERVAL: seconds between stock checks when nothing was taken
+# PLAN_POOL_DIET_BUCKETS / PLAN_POOL_EXERCISE_BUCKETS: ";"-separated preference strings to stock
+PLAN_POOL_ENABLED = os.getenv("PLAN_POOL_ENABLED", "1") == "1"
+PLAN_POOL_DEPTH = int(os.getenv("PLAN_POOL_DEPTH", "2"))
+PLAN_POOL_REFILL_INTERVAL = float(os.getenv("PLAN_POOL_REFILL_INTERVAL", "60"))
+PLAN_POOL_BUCKETS = {
+    "diet": os.getenv("PLAN_POOL_DIET_BUCKETS", ";vegetarian;low carb").split(";"),
+    "exercise": os.getenv("PLAN_POOL_EXERCISE_BUCKETS", ";beginner, no equipment").split(";"),
+}
+
+# plan_type -> async fn(llm, preferences) returning a validated weekly plan
+_generators: Dict[str, Callable[..., Awaitable[dict]]] = {}
+
+def register_generator(plan_type: str, generator: Callable[..., Awaitable[dict]]):
+    _generators[plan_type] = generator
+
+def is_stocked(plan_type: str, preferences: str) -> bool:
+    bucket = normalize(preferences)
+    return any(normalize(p) == bucket for p in PLAN_POOL_BUCKETS.get(plan_type, []))
+
+async def take_plan(plan_type: str, preferences: str) -> Optional[dict]:
+    """Remove and return one pre-generated plan for this bucket, or None if the pool is empty"""
+    if not PLAN_POOL_ENABLED or not is_stocked(plan_type, preferences):
+        return None
+    async with AsyncSessionLocal() as db:
+        entry = await db.scalar(
+            select(PlanPool)
+            .where(PlanPool.plan_type == plan_type, PlanPool.bucket == normalize(preferences))
+            .order_by(PlanPool.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        if entry is None:
+            return None
+        plan = entry.plan
+        await db.delete(entry)
+        await db.commit()
+    worker.wake()
+    return plan
+
+async def _stock_levels() -> Dict[tuple, int]:
+    async with AsyncSessionLocal() as db:
+        rows = await db.execute(
+            select(PlanPool.plan_type, PlanPool.bucket, func.count(PlanPool.id))
+            .group_by(PlanPool.plan_type, PlanPool.bucket)
+        )
+        return {(plan_type, bucket): count for plan_type, bucket, count in rows}
+
+async def _store_plan(plan_type: str, bucket: str, plan: dict):
+    async with AsyncSessionLocal() as db:
+        db.add(PlanPool(plan_type=plan_type, bucket=bucket, plan=plan))
+        await db.commit()
+
+class PlanPoolWorker:
+    """Background task that keeps every configured bucket stocked to PLAN_POOL_DEPTH"""
+
+    def __init__(self):
+        self._task = None
+        self._wake = None
+
+    def start(self, get_llm: Callable):
+        if not PLAN_POOL_ENABLED or self._task is not None:
+            return
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run(get_llm))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    async def status(self) -> dict:
+        levels = await _stock_levels()
+        return {
+            "enabled": PLAN_POOL_ENABLED,
+            "depth": PLAN_POOL_DEPTH,
+            "levels": {
+                plan_type: {preferences: levels.get((plan_type, normalize(preferences)), 0)
+                            for preferences in buckets}
+                for plan_type, buckets in PLAN_POOL_BUCKETS.items()
+            }
+        }
+
+    async def _run(self, get_llm: Callable):
+        while True:
+            try:
+                await self._refill(get_llm())
+            except HTTPException as e:
+                log.warning("Plan pool refill skipped", extra={"detail": e.detail})
+            except Exception:
+                log.exception("Plan pool refill failed")
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=PLAN_POOL_REFILL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _refill(self, llm):
+        levels = await _stock_levels()
+        for plan_type, buckets in PLAN_POOL_BUCKETS.items():
+            generator = _generators.get(plan_type)
+            if generator is None:
+                continue
+            for preferences in buckets:
+                bucket = normalize(preferences)
+                missing = PLAN_POOL_DEPTH - levels.get((plan_type, bucket), 0)
+                for _ in range(max(missing, 0)):
+                    try:
+                        with llm_deadline("background"):  # each plan gets its own budget
+                            plan = await generator(llm, preferences)
+                    except Exception as e:
+                        # Invalid plans are dropped; the next round tries again
+                        log.warning("Plan pool discarded a plan", extra={"plan_type": plan_type, "preferences": preferences, "error": str(e)})
+                        continue
+                    await _store_plan(plan_type, bucket, plan)
+
+worker = PlanPoolWorker()
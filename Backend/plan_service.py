@@ -0,0 +1,68 @@
+from typing import Awaitable, Callable, List, Optional
+from fastapi import HTTPException
+from sqlalchemy import delete, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import DATABASE_BACKEND
+from models import PlanDocument
+
+# Every change to a user's diet_plans / exercise_plans rows goes through
+# replace_plan_rows, so readers see either the old plan or the new one, never
+# an empty or half-written plan.
+
+_insert_or_ignore = sqlite.insert if DATABASE_BACKEND == "sqlite" else postgresql.insert
+
+async def lock_document(db: AsyncSession, user_id: int, plan_type: str) -> PlanDocument:
+    """Lock the user's plan document row, creating an empty version 0 placeholder if there is none
+
+    The placeholder is inserted with ON CONFLICT DO NOTHING, so concurrent
+    first writes queue on the same row instead of both inserting it. It never
+    outlives the transaction: the caller's refresh_document fills it in, or
+    deletes it when the plan ends up empty.
+    """
+    await db.execute(
+        _insert_or_ignore(PlanDocument)
+        .values(user_id=user_id, plan_type=plan_type, document={}, etag="", version=0)
+        .on_conflict_do_nothing(index_elements=["user_id", "plan_type"])
+    )
+    return await db.scalar(
+        select(PlanDocument)
+        .where(PlanDocument.user_id == user_id, PlanDocument.plan_type == plan_type)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )
+
+async def replace_plan_rows(
+    db: AsyncSession,
+    model,
+    plan_type: str,
+    user_id: int,
+    rows: List[dict],
+    refresh_document: Callable[[AsyncSession, int], Awaitable[Optional[PlanDocument]]],
+    *where,
+    expected_version: Optional[int] = None,
+) -> Optional[PlanDocument]:
+    """Swap the user's rows matching where for rows and rewrite the plan document in one transaction
+
+    rows must already be validated. The plan document row is locked first
+    (created if missing), so concurrent replacements for one user apply one
+    after another; when expected_version is given it must match the stored
+    version (0 for no plan).
+    """
+    try:
+        current = await lock_document(db, user_id, plan_type)
+        if expected_version is not None and current.version != expected_version:
+            raise HTTPException(status_code=409, detail=f"The {plan_type} plan was changed by another request")
+        await db.execute(delete(model).where(model.user_id == user_id, *where))
+        if rows:
+            # executemany: one round trip however many rows there are
+            await db.execute(insert(model), rows)
+        doc = await refresh_document(db, user_id)
+        await db.commit()
+        return doc
+    except HTTPException:
+        await db.rollback()
+        raise
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=f"Failed to save {plan_type} plan: {str(e)}")
@@ -0,0 +1,255 @@
+import asyncio
+import json
+import math
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, Optional
+from fastapi import HTTPException
+from google.api_core.exceptions import ServerError, TooManyRequests
+from cache import MemoryCacheBackend, ResponseCache
+from telemetry import get_logger, llm_breaker_transitions, llm_hedges
+from dotenv import load_dotenv
+
+load_dotenv()
+
+log = get_logger("resilience")
+
+# LLM resilience settings
+# LLM_DEADLINE_CHAT / LLM_DEADLINE_PLAN / LLM_DEADLINE_BACKGROUND: seconds an endpoint class may
+#   spend on the LLM in total, retries, hedges and fallback included
+# LLM_RETRY_ATTEMPTS: extra attempts on the primary model after a transient error
+# LLM_HEDGE_PERCENTILE: send a duplicate request once a call has been out longer than this
+#   percentile of the model's recent latencies (0 disables hedging)
+# LLM_HEDGE_MIN_SAMPLES: latencies a model needs before its calls are hedged
+# LLM_BREAKER_FAILURES: consecutive transient failures that open a model's circuit breaker
+# LLM_BREAKER_COOLDOWN: seconds an open breaker rejects calls before letting one probe through
+# LLM_FALLBACK_MODEL: cheaper/faster model tried when the primary fails, times out or is open ("" disables)
+# LLM_FALLBACK_CACHE_TTL / LLM_FALLBACK_CACHE_ENTRIES: last good answer per prompt, served when every model fails
+LLM_DEADLINES = {
+    "chat": float(os.getenv("LLM_DEADLINE_CHAT", "20")),
+    "plan": float(os.getenv("LLM_DEADLINE_PLAN", "90")),
+    "background": float(os.getenv("LLM_DEADLINE_BACKGROUND", "180")),
+}
+LLM_RETRY_ATTEMPTS = int(os.getenv("LLM_RETRY_ATTEMPTS", "1"))
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL", "gemini-2.5-flash-lite")
+LLM_FALLBACK_CACHE_TTL = float(os.getenv("LLM_FALLBACK_CACHE_TTL", "604800"))
+LLM_FALLBACK_CACHE_ENTRIES = int(os.getenv("LLM_FALLBACK_CACHE_ENTRIES", "512"))
+
+def is_transient(error: BaseException) -> bool:
+    """Errors worth another attempt: provider 5xx/429, timeouts and dropped connections"""
+    if isinstance(error, HTTPException):
+        return error.status_code == 504  # raised by llm.generate_content on timeout
+    return isinstance(error, (ServerError, TooManyRequests, asyncio.TimeoutError, ConnectionError))
+
+# ----------------------
+# Deadlines
+# ----------------------
+_deadline: ContextVar[Optional[float]] = ContextVar("llm_deadline", default=None)
+
+def remaining() -> float:
+    """Seconds left before the current deadline (infinite when none is set)"""
+    deadline = _deadline.get()
+    return math.inf if deadline is None else deadline - time.monotonic()
+
+@contextmanager
+def llm_deadline(kind: str):
+    """Give the LLM calls made inside the block LLM_DEADLINES[kind] seconds in total"""
+    token = _deadline.set(time.monotonic() + LLM_DEADLINES[kind])
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def deadline(kind: str) -> Callable:
+    """Route dependency that starts an LLM_DEADLINES[kind] budget for the request"""
+    async def start_deadline():
+        _deadline.set(time.monotonic() + LLM_DEADLINES[kind])
+    return start_deadline
+
+# ----------------------
+# Latency tracking and hedging
+# ----------------------
+class LatencyWindow:
+    """Latencies of a model's most recent successful calls"""
+
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """None until LLM_HEDGE_MIN_SAMPLES calls have been seen"""
+        if len(self._samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+async def hedged(
+    attempt: Callable[[float], Awaitable],
+    budget: float,
+    hedge_after: Optional[float],
+    model: str,
+    can_hedge: Callable[[], bool] = lambda: True,
+):
+    """Run attempt(budget); if it is still out after hedge_after seconds, race a duplicate against it
+
+    The first success wins and the other request is cancelled. An error
+    only surfaces once both requests have failed.
+    """
+    first = asyncio.ensure_future(attempt(budget))
+    if hedge_after is None or hedge_after >= budget:
+        return await first
+    pending = {first}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=hedge_after)
+        if done:
+            return first.result()
+        if not can_hedge():
+            return await first
+        llm_hedges.inc(model=model, outcome="sent")
+        second = asyncio.ensure_future(attempt(budget - hedge_after))
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winners = [task for task in done if task.exception() is None]
+            if winners:
+                if winners[0] is second:
+                    llm_hedges.inc(model=model, outcome="won")
+                return winners[0].result()
+            error = next(iter(done)).exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+# ----------------------
+# Circuit breaker
+# ----------------------
+class CircuitBreaker:
+    """Stop calling a model after LLM_BREAKER_FAILURES consecutive failures
+
+    Closed: calls go through. Open: calls are rejected for LLM_BREAKER_COOLDOWN
+    seconds. Half-open: one probe call is let through; its outcome closes or
+    re-opens the breaker.
+    """
+
+    def __init__(self, model: str, failures: int = LLM_BREAKER_FAILURES, cooldown: float = LLM_BREAKER_COOLDOWN):
+        self.model = model
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def _transition(self, state: str):
+        if state != self.state:
+            self.state = state
+            llm_breaker_transitions.inc(model=self.model, state=state)
+            log.warning("LLM circuit breaker %s", state, extra={"model": self.model, "failures": self.failures})
+
+    def retry_after(self) -> float:
+        return max(self.opened_at + self.cooldown - time.monotonic(), 0.0)
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and not self.retry_after():
+            self._transition("half_open")
+            return True
+        return False  # open, or half-open with its probe still out
+
+    def record_success(self):
+        self.failures = 0
+        self._transition("closed")
+
+    def abandon(self):
+        """A call allowed through ended with no outcome (cancelled, client gone)
+
+        If it was the half-open probe, the next call probes instead; otherwise
+        nothing would ever resolve the half-open state.
+        """
+        if self.state == "half_open":
+            self.opened_at = time.monotonic() - self.cooldown
+            self._transition("open")
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.max_failures:
+            self.opened_at = time.monotonic()
+            self._transition("open")
+
+class ModelHealth:
+    """Breaker and latency window per model name"""
+
+    def __init__(self):
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.latencies: Dict[str, LatencyWindow] = {}
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker(model)
+        return self.breakers[model]
+
+    def latency(self, model: str) -> LatencyWindow:
+        if model not in self.latencies:
+            self.latencies[model] = LatencyWindow()
+        return self.latencies[model]
+
+    def retry_after(self) -> float:
+        """Seconds until the first open breaker lets a probe through"""
+        waits = [breaker.retry_after() for breaker in self.breakers.values() if breaker.state == "open"]
+        return min(waits) if waits else 0.0
+
+    def status(self) -> dict:
+        return {
+            model: {
+                "state": breaker.state,
+                "failures": breaker.failures,
+                "retry_after": round(breaker.retry_after(), 1) if breaker.state == "open" else 0,
+                "hedge_after": self.latency(model).percentile(LLM_HEDGE_PERCENTILE) if LLM_HEDGE_PERCENTILE else None,
+            }
+            for model, breaker in self.breakers.items()
+        }
+
+health = ModelHealth()
+
+# ----------------------
+# Last good answers
+# ----------------------
+class CachedResponse:
+    """Stand-in for a Gemini response when a stored answer is served"""
+
+    usage_metadata = None
+
+    def __init__(self, text: str):
+        self.text = text
+
+last_good_answers = ResponseCache(MemoryCacheBackend(LLM_FALLBACK_CACHE_ENTRIES), ttl=LLM_FALLBACK_CACHE_TTL)
+
+def _answer_key(prompt, kwargs: dict) -> Optional[tuple]:
+    if not isinstance(prompt, str):
+        return None
+    return prompt, json.dumps(kwargs, sort_keys=True, default=str)
+
+def remember_answer(prompt, kwargs: dict, response):
+    key = _answer_key(prompt, kwargs)
+    if key is None:
+        return
+    try:
+        last_good_answers.set("llm", response.text, *key)
+    except ValueError:
+        pass  # blocked or empty response: nothing worth serving later
+
+def stored_answer(prompt, kwargs: dict) -> Optional[CachedResponse]:
+    key = _answer_key(prompt, kwargs)
+    text = last_good_answers.get("llm", *key) if key else None
+    return CachedResponse(text) if text is not None else None
@@ -1,22 +1,20 @@
 from fastapi import APIRouter, Depends, HTTPException, Header
-from sqlalchemy.orm import Session
-from database import SessionLocal
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_db
 from models import User
-from auth import password_hash, verify_password, create_access_token, decode_access_token
-from pydantic import BaseModel
+from auth import password_hash, verify_and_update_password, create_access_token, decode_access_token, revoke_token, is_revoked
+from cache import MemoryCacheBackend
+from pydantic import BaseModel, ConfigDict
 from typing import Optional
+import os
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
-# ----------------------
-# Dependency: get DB session
-# ----------------------
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# Users looked up by verify_token are cached by id for AUTH_USER_CACHE_TTL seconds;
+# this also bounds how long a logout on another worker takes to apply here
+AUTH_USER_CACHE_TTL = float(os.getenv("AUTH_USER_CACHE_TTL", "30"))
+user_cache = MemoryCacheBackend(max_entries=int(os.getenv("AUTH_USER_CACHE_SIZE", "4096")))
 
 # ----------------------
 # Pydantic models
@@ -34,35 +32,40 @@ class LoginRequest(BaseModel):
 # Register endpoint
 # ----------------------
 @router.post("/register")
-def register(data: RegisterRequest, db: Session = Depends(get_db)):
+async def register(data: RegisterRequest, db: AsyncSession = Depends(get_db)):
     # Check if username or email already exists
-    existing_user = db.query(User).filter(
+    existing_user = await db.scalar(select(User.id).where(
         (User.username == data.username) | (User.email == data.email)
-    ).first()
+    ).limit(1))
     if existing_user:
         raise HTTPException(status_code=400, detail="User already exists")
     
-    hashed = password_hash(data.password)
+    hashed = await password_hash(data.password)
     user = User(username=data.username, email=data.email, password=hashed)
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.commit()
     return {"message": "User registered successfully", "user_id": user.id}
 
 # ----------------------
 # Login endpoint
 # ----------------------
 @router.post("/login")
-def login(data: LoginRequest, db: Session = Depends(get_db)):
+async def login(data: LoginRequest, db: AsyncSession = Depends(get_db)):
     # Query by email
-    user = db.query(User).filter(User.email == data.email).first()
-    if not user or not verify_password(data.password, user.password):
+    user = await db.scalar(select(User).where(User.email == data.email))
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    verified, new_hash = await verify_and_update_password(data.password, user.password)
+    if not verified:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    # Generate token and save to database
-    token = create_access_token({"sub": user.username, "user_id": user.id})
-    user.token = token
-    db.commit()
+    # Transparently upgrade hashes made with a different BCRYPT_ROUNDS
+    if new_hash:
+        user.password = new_hash
+        await db.commit()
+    
+    # Generate token; it is verified statelessly, so nothing is written back
+    token = create_access_token({"sub": user.username, "user_id": user.id, "ver": user.token_version})
     
     return {
         "access_token": token,
@@ -77,8 +80,8 @@ def login(data: LoginRequest, db: Session = Depends(get_db)):
 # ----------------------
 # Token verification dependency
 # ----------------------
-def verify_token(authorization: Optional[str] = Header(None), db: Session = Depends(get_db)):
-    """Verify token from database and return user"""
+async def verify_token(authorization: Optional[str] = Header(None), db: AsyncSession = Depends(get_db)):
+    """Verify the JWT and return its user (read-only, detached from the session)"""
     if not authorization:
         raise HTTPException(status_code=401, detail="No authorization token provided")
     
@@ -90,17 +93,25 @@ def verify_token(authorization: Optional[str] = Header(None), db: Session = Depe
     except ValueError:
         raise HTTPException(status_code=401, detail="Invalid authorization header")
     
-    # Check if token exists in database
-    user = db.query(User).filter(User.token == token).first()
-    if not user:
+    # Verify signature and expiry before touching the database
+    payload = decode_access_token(token)
+    if not payload or is_revoked(payload):
         raise HTTPException(status_code=401, detail="Invalid or expired token")
     
-    # Verify token is valid
-    payload = decode_access_token(token)
-    if not payload:
-        # Token is invalid, clear it from database
-        user.token = None
-        db.commit()
+    # Fetch the user by primary key, at most once per AUTH_USER_CACHE_TTL. A token newer
+    # than the cached user means it logged out and back in (maybe via another worker)
+    user = user_cache.get(payload["user_id"])
+    if user is None or payload["ver"] > user.token_version:
+        user = await db.get(User, payload["user_id"])
+        if not user:
+            raise HTTPException(status_code=401, detail="Invalid or expired token")
+        db.expunge(user)
+        # End the read so the request doesn't hold a pooled connection through slow work (LLM calls)
+        await db.rollback()
+        user_cache.set(payload["user_id"], user, AUTH_USER_CACHE_TTL)
+    
+    # Tokens issued before the user's last logout are revoked
+    if payload["ver"] != user.token_version:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
     
     return user
@@ -109,17 +120,23 @@ def verify_token(authorization: Optional[str] = Header(None), db: Session = Depe
 # Logout endpoint
 # ----------------------
 @router.post("/logout")
-def logout(user: User = Depends(verify_token), db: Session = Depends(get_db)):
-    """Clear user token from database"""
-    user.token = None
-    db.commit()
+async def logout(authorization: Optional[str] = Header(None), user: User = Depends(verify_token), db: AsyncSession = Depends(get_db)):
+    """Revoke every token issued to the user so far"""
+    await db.execute(
+        update(User).where(User.id == user.id).values(token_version=User.token_version + 1, token=None)
+    )
+    await db.commit()
+    # Deny this exact token in memory right away; token_version covers the rest
+    revoke_token(decode_access_token(authorization.split()[1]))
+    user_cache.delete(user.id)
+    profile_cache.delete(user.id)
     return {"message": "Logged out successfully"}
 
 # ----------------------
 # Verify token endpoint (check if user is authenticated)
 # ----------------------
 @router.get("/verify")
-def verify_user(user: User = Depends(verify_token)):
+async def verify_user(user: User = Depends(verify_token)):
     """Verify if token is valid and return user info"""
     return {
         "authenticated": True,
@@ -131,31 +148,23 @@ def verify_user(user: User = Depends(verify_token)):
     }
 
 # ----------------------
-# Get user profile
+# Profile models
 # ----------------------
-@router.get("/profile")
-def get_profile(user: User = Depends(verify_token)):
-    """Get current user's profile information"""
-    return {
-        "success": True,
-        "profile": {
-            "id": user.id,
-            "username": user.username,
-            "email": user.email,
-            "phone": user.phone,
-            "age": user.age,
-            "gender": user.gender,
-            "blood_type": user.blood_type,
-            "height": user.height,
-            "weight": user.weight,
-            "allergies": user.allergies,
-            "emergency_contact": user.emergency_contact
-        }
-    }
+class ProfileResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    username: str
+    email: str
+    phone: Optional[str] = None
+    age: Optional[int] = None
+    gender: Optional[str] = None
+    blood_type: Optional[str] = None
+    height: Optional[float] = None
+    weight: Optional[float] = None
+    allergies: Optional[str] = None
+    emergency_contact: Optional[str] = None
 
-# ----------------------
-# Update user profile
-# ----------------------
 class UpdateProfileRequest(BaseModel):
     phone: Optional[str] = None
     age: Optional[int] = None
@@ -166,44 +175,49 @@ class UpdateProfileRequest(BaseModel):
     allergies: Optional[str] = None
     emergency_contact: Optional[str] = None
 
+PROFILE_COLUMNS = [getattr(User, field) for field in ProfileResponse.model_fields]
+
+# Serialized profiles by user id; update_profile replaces the entry. The cache is per
+# worker, so with several workers an edit can take up to PROFILE_CACHE_TTL seconds
+# to show on the others
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "30"))
+profile_cache = MemoryCacheBackend(max_entries=int(os.getenv("PROFILE_CACHE_SIZE", "4096")))
+
+# ----------------------
+# Get user profile
+# ----------------------
+@router.get("/profile")
+async def get_profile(user: User = Depends(verify_token), db: AsyncSession = Depends(get_db)):
+    """Get current user's profile information"""
+    profile = profile_cache.get(user.id)
+    if profile is None:
+        # Read the row itself: the verify_token user may be cached from before an edit
+        row = (await db.execute(select(*PROFILE_COLUMNS).where(User.id == user.id))).mappings().one()
+        profile = ProfileResponse(**row).model_dump()
+        profile_cache.set(user.id, profile, PROFILE_CACHE_TTL)
+    return {"success": True, "profile": profile}
+
+# ----------------------
+# Update user profile
+# ----------------------
 @router.put("/profile")
-def update_profile(data: UpdateProfileRequest, user: User = Depends(verify_token), db: Session = Depends(get_db)):
+async def update_profile(data: UpdateProfileRequest, user: User = Depends(verify_token), db: AsyncSession = Depends(get_db)):
     """Update current user's profile information"""
-    # Update only provided fields
-    if data.phone is not None:
-        user.phone = data.phone
-    if data.age is not None:
-        user.age = data.age
-    if data.gender is not None:
-        user.gender = data.gender
-    if data.blood_type is not None:
-        user.blood_type = data.blood_type
-    if data.height is not None:
-        user.height = data.height
-    if data.weight is not None:
-        user.weight = data.weight
-    if data.allergies is not None:
-        user.allergies = data.allergies
-    if data.emergency_contact is not None:
-        user.emergency_contact = data.emergency_contact
-    
-    db.commit()
-    db.refresh(user)
+    # Update only provided fields, reading the new row back in the same statement
+    values = data.model_dump(exclude_none=True)
+    if values:
+        row = (await db.execute(
+            update(User).where(User.id == user.id).values(**values).returning(*PROFILE_COLUMNS)
+        )).mappings().one()
+        await db.commit()
+        profile = ProfileResponse(**row).model_dump()
+        user_cache.delete(user.id)
+    else:
+        profile = ProfileResponse.model_validate(user).model_dump()
+    profile_cache.set(user.id, profile, PROFILE_CACHE_TTL)
     
     return {
         "success": True,
         "message": "Profile updated successfully",
-        "profile": {
-            "id": user.id,
-            "username": user.username,
-            "email": user.email,
-            "phone": user.phone,
-            "age": user.age,
-            "gender": user.gender,
-            "blood_type": user.blood_type,
-            "height": user.height,
-            "weight": user.weight,
-            "allergies": user.allergies,
-            "emergency_contact": user.emergency_contact
-        }
+        "profile": profile
     }
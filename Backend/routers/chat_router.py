@@ -1,73 +1,89 @@
-from fastapi import APIRouter, HTTPException
-import google.generativeai as genai
-import os
+from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from dotenv import load_dotenv
-
-load_dotenv()
+from llm import LLMClient, get_llm
+from models import User
+from routers.auth_router import verify_token
+from resilience import deadline
+from singleflight import llm_flights
+from streaming import sse_event
+from cache import response_cache
+from conversation import Conversation, conversations
+from intents import IntentRouter
+from typing import Optional
 
 router = APIRouter(prefix="/chat", tags=["chat"])
 
-# Configure the Gemini API
-GEMINI_API_KEY = os.getenv("GEMINIAPI")
-if not GEMINI_API_KEY:
-    print("Warning: GEMINIAPI environment variable not set.")
-
-genai.configure(api_key=GEMINI_API_KEY)
-
 class ChatRequest(BaseModel):
     message: str
-    user_id: int = 1  # Default user ID
+    session_id: str = "default"  # separate conversations for the same user
+
+DIET_KEYWORDS = [
+    'diet plan', 'meal plan', 'diet', 'nutrition plan', 'eating plan',
+    'food plan', 'weekly diet', 'daily diet', 'create diet', 'make diet'
+]
+
+EXERCISE_KEYWORDS = [
+    'exercise plan', 'workout plan', 'exercise', 'workout', 'fitness plan',
+    'training plan', 'gym plan', 'create exercise', 'make workout'
+]
+
+DIET_REPLY = ("I can help you create a personalized diet plan! 🍽️\n\n" +
+              "To generate your diet plan:\n" +
+              "• Open the sidebar menu\n" +
+              "• Go to 'Diet Plan'\n" +
+              "• You'll find an AI-generated weekly meal plan with detailed nutrition information\n\n" +
+              "The diet plan includes breakfast, lunch, dinner, and snacks for all 7 days of the week!")
+
+EXERCISE_REPLY = ("I can help you create a personalized exercise plan! 💪\n\n" +
+                  "To generate your exercise plan:\n" +
+                  "• Open the sidebar menu\n" +
+                  "• Go to 'Exercise Plan'\n" +
+                  "• You'll find an AI-generated weekly workout plan organized by category\n\n" +
+                  "The plan includes Cardio, Strength, and Flexibility exercises for all 7 days!")
+
+GREETING_REPLY = ("Hello! 👋 I'm MediNova, your health assistant.\n\n" +
+                  "Ask me about symptoms, medications, nutrition or fitness, " +
+                  "or open the sidebar for your diet and exercise plans.")
+
+THANKS_REPLY = "You're welcome! 😊 Let me know if you have any other health questions."
+
+CAPABILITIES_REPLY = ("I can help with:\n" +
+                      "• General health and medical questions\n" +
+                      "• Personalized weekly diet plans (sidebar → 'Diet Plan')\n" +
+                      "• Personalized weekly exercise plans (sidebar → 'Exercise Plan')\n\n" +
+                      "I give general information only and don't replace a doctor.")
+
+PROFILE_REPLY = ("To update your profile:\n" +
+                 "• Open the sidebar menu\n" +
+                 "• Go to 'Profile'\n" +
+                 "• Edit your details such as age, height, weight, allergies and emergency contact")
+
+DISCLAIMER_REPLY = ("No. I provide general health information only, not a diagnosis or treatment. 🩺\n\n" +
+                    "• Always consult a qualified healthcare professional for medical decisions\n" +
+                    "• In an emergency, call your local emergency number right away")
+
+# Messages answered locally, without an LLM call
+intent_router = IntentRouter()
+intent_router.add_pattern(
+    "greeting", r"(hi+|hello|hey+|hiya|good (morning|afternoon|evening))( there)?[\s!.,]*", GREETING_REPLY
+)
+intent_router.add_pattern("thanks", r"(thanks|thank you|thx|ty)( (so|very) much)?[\s!.,]*", THANKS_REPLY)
+intent_router.add_faq("faq_capabilities", [
+    "what can you do", "what can you help me with", "who are you", "what are you", "how can you help me"
+], CAPABILITIES_REPLY)
+intent_router.add_faq("faq_profile", [
+    "how do i update my profile", "how can i edit my profile", "where can i change my profile"
+], PROFILE_REPLY)
+intent_router.add_faq("faq_disclaimer", [
+    "is this medical advice", "can you replace my doctor", "are you a doctor", "are you a real doctor"
+], DISCLAIMER_REPLY)
+intent_router.add_keywords("diet_plan", DIET_KEYWORDS, DIET_REPLY, plan_type="diet")
+intent_router.add_keywords("exercise_plan", EXERCISE_KEYWORDS, EXERCISE_REPLY, plan_type="exercise")
+
+# Create a prompt that requests point-to-point answers
+SYSTEM_INSTRUCTION = """You are a helpful medical AI assistant. Provide concise, point-to-point answers.
 
-@router.post("/")
-async def chat(request: ChatRequest):
-    """Handle general chat conversations with Gemini AI"""
-    if not GEMINI_API_KEY:
-        raise HTTPException(status_code=500, detail="Gemini API key not configured")
-    
-    try:
-        message_lower = request.message.lower()
-        
-        # Check for diet plan keywords
-        is_diet_request = any(keyword in message_lower for keyword in [
-            'diet plan', 'meal plan', 'diet', 'nutrition plan', 'eating plan',
-            'food plan', 'weekly diet', 'daily diet', 'create diet', 'make diet'
-        ])
-        
-        # Check for exercise plan keywords
-        is_exercise_request = any(keyword in message_lower for keyword in [
-            'exercise plan', 'workout plan', 'exercise', 'workout', 'fitness plan',
-            'training plan', 'gym plan', 'create exercise', 'make workout'
-        ])
-        
-        if is_diet_request:
-            return {
-                "response": "I can help you create a personalized diet plan! 🍽️\n\n" +
-                           "To generate your diet plan:\n" +
-                           "• Open the sidebar menu\n" +
-                           "• Go to 'Diet Plan'\n" +
-                           "• You'll find an AI-generated weekly meal plan with detailed nutrition information\n\n" +
-                           "The diet plan includes breakfast, lunch, dinner, and snacks for all 7 days of the week!",
-                "user_id": request.user_id,
-                "plan_type": "diet"
-            }
-        
-        if is_exercise_request:
-            return {
-                "response": "I can help you create a personalized exercise plan! 💪\n\n" +
-                           "To generate your exercise plan:\n" +
-                           "• Open the sidebar menu\n" +
-                           "• Go to 'Exercise Plan'\n" +
-                           "• You'll find an AI-generated weekly workout plan organized by category\n\n" +
-                           "The plan includes Cardio, Strength, and Flexibility exercises for all 7 days!",
-                "user_id": request.user_id,
-                "plan_type": "exercise"
-            }
-        print(request.user_id)
-        
-        # Create a prompt that requests point-to-point answers
-        system_instruction = """You are a helpful medical AI assistant. Provide concise, point-to-point answers.
-        
 Guidelines:
 - Give clear, direct responses
 - Use bullet points when listing multiple items
@@ -75,18 +91,103 @@ Guidelines:
 - Focus on the most important information
 - Avoid lengthy paragraphs
 
-User Question: """
-        
-        full_prompt = system_instruction + request.message
-        
-        # Use Gemini AI for general health-related chat
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(full_prompt)
-        
+"""
+
+def build_chat_prompt(conversation: Conversation, message: str) -> str:
+    """System instruction, the bounded conversation context, then the new question"""
+    context = conversation.context()
+    return SYSTEM_INSTRUCTION + (context + "\n\n" if context else "") + "User Question: " + message
+
+def local_reply(request: ChatRequest, user: User) -> Optional[dict]:
+    """Return the local answer for greetings, FAQs and plan requests, or None"""
+    reply = intent_router.route(request.message)
+    if reply:
+        reply["user_id"] = user.id
+    return reply
+
+@router.post("/", dependencies=[Depends(deadline("chat"))])
+async def chat(request: ChatRequest, user: User = Depends(verify_token), llm: LLMClient = Depends(get_llm)):
+    """Handle general chat conversations with Gemini AI"""
+    try:
+        reply = local_reply(request, user)
+        if reply:
+            return reply
+
+        # Memory holds health details, so it is keyed on the authenticated user only
+        conversation = await conversations.get(user.id, request.session_id)
+        async with conversation.lock:
+            # Cached answers only fit a conversation's first question
+            answer = response_cache.get("chat", llm.model_name, request.message) if conversation.empty else None
+            if answer is None:
+                # Use Gemini AI for general health-related chat; identical prompts in
+                # flight (e.g. the same first question from many users) share one call
+                prompt = build_chat_prompt(conversation, request.message)
+                response = await llm_flights.run("chat", lambda: llm.generate(prompt), llm.model_name, prompt)
+                answer = response.text
+                if conversation.empty:
+                    response_cache.set("chat", answer, llm.model_name, request.message)
+            await conversations.record(conversation, request.message, answer, llm)
+
         return {
-            "response": response.text,
-            "user_id": request.user_id
+            "response": answer,
+            "user_id": user.id
         }
-            
+
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/stream", dependencies=[Depends(deadline("chat"))])
+async def chat_stream(request: ChatRequest, user: User = Depends(verify_token), llm: LLMClient = Depends(get_llm)):
+    """Stream the chat reply as Server-Sent Events while Gemini generates it
+
+    Each event carries {"delta": "..."}; the last one is {"done": true, ...}
+    with the same fields the non-streaming endpoint returns.
+    """
+    reply = local_reply(request, user)
+    conversation = None if reply else await conversations.get(user.id, request.session_id)
+
+    async def events():
+        if reply:
+            yield sse_event({"delta": reply["response"]})
+            yield sse_event({"done": True, **reply})
+            return
+
+        async with conversation.lock:
+            first_question = conversation.empty
+            answer = response_cache.get("chat", llm.model_name, request.message) if first_question else None
+            if answer is not None:
+                yield sse_event({"delta": answer})
+            else:
+                parts = []
+                try:
+                    async for text in llm.stream(build_chat_prompt(conversation, request.message)):
+                        parts.append(text)
+                        yield sse_event({"delta": text})
+                except HTTPException as e:
+                    yield sse_event({"detail": e.detail, "status_code": e.status_code}, event="error")
+                    return
+                except Exception as e:
+                    yield sse_event({"detail": str(e), "status_code": 500}, event="error")
+                    return
+
+                answer = "".join(parts)
+                if first_question:
+                    response_cache.set("chat", answer, llm.model_name, request.message)
+            await conversations.record(conversation, request.message, answer, llm)
+        yield sse_event({"done": True, "response": answer, "user_id": user.id})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.delete("/history/{user_id}")
+async def clear_chat_history(user_id: int, session_id: str = "default", user: User = Depends(verify_token)):
+    """Forget one of the signed-in user's conversations so the next message starts fresh"""
+    if user_id != user.id:
+        raise HTTPException(status_code=403, detail="Not allowed to clear another user's chat history")
+    await conversations.clear(user.id, session_id)
+    return {"success": True, "message": "Chat history cleared"}
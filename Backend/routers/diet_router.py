@@ -1,30 +1,23 @@
-from fastapi import APIRouter, HTTPException, Depends
-from sqlalchemy.orm import Session
-from database import SessionLocal
-from models import DietPlan
+from fastapi import APIRouter, HTTPException, Depends, Header
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal, get_db
+from models import DietPlan, DayName, MealTypeName, MEAL_TYPES
 from pydantic import BaseModel
-from typing import List
-import google.generativeai as genai
-import os
-from dotenv import load_dotenv
-import json
-
-load_dotenv()
+from typing import Dict, List, Optional
+from llm import LLMClient, get_llm
+from resilience import deadline
+from singleflight import llm_flights
+from cache import response_cache
+from streaming import DAYS, sse_event, stream_week_plan, fan_out_week_plan
+from plan_pool import register_generator, take_plan
+from plan_documents import backfill_document, document_response, get_document, read_document, write_document, slot_name, summarize_week
+from plan_service import lock_document, replace_plan_rows
+from structured import generate_validated, generate_validated_list, generate_validated_week
 
 router = APIRouter(prefix="/diet", tags=["diet"])
 
-# Configure Gemini API
-GEMINI_API_KEY = os.getenv("GEMINIAPI")
-genai.configure(api_key=GEMINI_API_KEY)
-
-# Dependency: get DB session
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 # Pydantic models
 class MealItem(BaseModel):
     name: str
@@ -42,6 +35,7 @@ class DayPlan(BaseModel):
 class GenerateDietRequest(BaseModel):
     user_id: int
     preferences: str = ""  # e.g., "vegetarian, low carb"
+    fan_out: bool = False  # generate the 7 days as concurrent single-day requests
 
 class SaveDietRequest(BaseModel):
     user_id: int
@@ -53,15 +47,17 @@ class SaveDietRequest(BaseModel):
     carbs: float
     fat: float
 
-@router.post("/generate")
-async def generate_diet_plan(request: GenerateDietRequest):
-    """Generate a personalized diet plan using Gemini AI"""
-    if not GEMINI_API_KEY:
-        raise HTTPException(status_code=500, detail="Gemini API key not configured")
-    
-    try:
-        prompt = f"""Generate a healthy, balanced 7-day diet plan for one week (Monday to Sunday).
-        User preferences: {request.preferences if request.preferences else 'None'}
+class SaveDietPlanRequest(BaseModel):
+    user_id: int
+    diet_plan: Dict[str, DayPlan]  # same shape as /diet/generate returns
+    expected_version: Optional[int] = None  # reject with 409 if the stored plan has moved on
+
+class RegenerateDietRequest(BaseModel):
+    preferences: str = ""
+
+def build_diet_prompt(preferences: str) -> str:
+    return f"""Generate a healthy, balanced 7-day diet plan for one week (Monday to Sunday).
+        User preferences: {preferences if preferences else 'None'}
         
         For each day, provide:
         - Breakfast: 2 meal items
@@ -83,54 +79,74 @@ async def generate_diet_plan(request: GenerateDietRequest):
         }}
         
         Keep meal names simple and realistic. Ensure nutritional values are accurate."""
+
+def build_diet_day_prompt(preferences: str, day: str, week_context: str = "") -> str:
+    context = f"\n        Rest of the week (use different meals):\n{week_context}\n" if week_context else ""
+    return f"""Generate a healthy, balanced diet plan for {day}.
+        User preferences: {preferences if preferences else 'None'}
+        {context}
         
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(prompt)
+        Provide:
+        - Breakfast: 2 meal items
+        - Lunch: 2 meal items  
+        - Dinner: 2 meal items
+        - Snacks: 2 meal items
         
-        # Parse the response
-        response_text = response.text.strip()
-        # Remove markdown code blocks if present
-        if response_text.startswith("```"):
-            response_text = response_text.split("```")[1]
-            if response_text.startswith("json"):
-                response_text = response_text[4:]
-            response_text = response_text.strip()
+        For each meal item, include: name, calories (number), protein (g), carbs (g), fat (g)
         
-        diet_plan = json.loads(response_text)
+        Return ONLY valid JSON in this exact format:
+        {{
+            "breakfast": [{{"name": "...", "calories": 320, "protein": 12, "carbs": 54, "fat": 6}}, ...],
+            "lunch": [...],
+            "dinner": [...],
+            "snacks": [...]
+        }}
         
-        return {"success": True, "diet_plan": diet_plan}
-    except json.JSONDecodeError as e:
-        raise HTTPException(status_code=500, detail=f"Failed to parse AI response: {str(e)}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        Keep meal names simple and realistic. Ensure nutritional values are accurate."""
 
-@router.post("/save")
-def save_diet_meal(meal: SaveDietRequest, db: Session = Depends(get_db)):
-    """Save a single meal to the database"""
-    diet_entry = DietPlan(
-        user_id=meal.user_id,
-        day=meal.day,
-        meal_type=meal.meal_type,
-        meal_name=meal.meal_name,
-        calories=meal.calories,
-        protein=meal.protein,
-        carbs=meal.carbs,
-        fat=meal.fat
-    )
-    db.add(diet_entry)
-    db.commit()
-    db.refresh(diet_entry)
-    return {"success": True, "id": diet_entry.id}
+def build_diet_slot_prompt(preferences: str, day: str, meal_type: str, count: int, week_context: str, current: List[str]) -> str:
+    return f"""Replace the {meal_type} for {day} in a weekly diet plan.
+        User preferences: {preferences if preferences else 'None'}
+        
+        Current week plan:
+{week_context}
+        
+        Do not reuse the current {day} {meal_type}: {', '.join(current) if current else 'None'}
+        
+        Provide {count} new {meal_type} items that fit with the rest of the week.
+        For each meal item, include: name, calories (number), protein (g), carbs (g), fat (g)
+        
+        Return ONLY valid JSON in this exact format:
+        [{{"name": "...", "calories": 320, "protein": 12, "carbs": 54, "fat": 6}}, ...]
+        
+        Keep meal names simple and realistic. Ensure nutritional values are accurate."""
 
-@router.get("/{user_id}")
-def get_diet_plan(user_id: int, db: Session = Depends(get_db)):
-    """Retrieve diet plan for a user"""
-    meals = db.query(DietPlan).filter(DietPlan.user_id == user_id).all()
-    
-    if not meals:
-        return {"success": False, "message": "No diet plan found"}
-    
-    # Group meals by day and meal type
+def meal_rows(user_id: int, day: str, meal_type: str, items: List[MealItem]) -> List[dict]:
+    """Flatten one meal slot into diet_plans rows"""
+    return [
+        {
+            "user_id": user_id,
+            "day": day,
+            "meal_type": meal_type,
+            "meal_name": item.name,
+            "calories": item.calories,
+            "protein": item.protein,
+            "carbs": item.carbs,
+            "fat": item.fat
+        }
+        for item in items
+    ]
+
+def diet_rows(user_id: int, day: str, day_plan: DayPlan) -> List[dict]:
+    """Flatten one day of a plan into diet_plans rows"""
+    return [
+        row
+        for meal_type in MEAL_TYPES
+        for row in meal_rows(user_id, day, meal_type, getattr(day_plan, meal_type))
+    ]
+
+def group_diet_rows(meals: List[DietPlan]) -> dict:
+    """Group meals by day and meal type"""
     diet_plan = {}
     for meal in meals:
         if meal.day not in diet_plan:
@@ -143,12 +159,229 @@ def get_diet_plan(user_id: int, db: Session = Depends(get_db)):
             "carbs": meal.carbs,
             "fat": meal.fat
         })
+    return diet_plan
+
+async def refresh_diet_document(db: AsyncSession, user_id: int):
+    """Rebuild the stored plan document from the user's rows; the caller commits"""
+    meals = (await db.scalars(
+        select(DietPlan).where(DietPlan.user_id == user_id).order_by(DietPlan.day, DietPlan.id)
+    )).all()
+    return await write_document(db, user_id, "diet", group_diet_rows(meals))
+
+async def replace_diet_rows(db: AsyncSession, user_id: int, rows: List[dict], *where, expected_version: Optional[int] = None):
+    """Atomically swap the user's rows matching where (all rows if none) for rows"""
+    return await replace_plan_rows(
+        db, DietPlan, "diet", user_id, rows, refresh_diet_document, *where, expected_version=expected_version
+    )
+
+async def generate_diet_week(llm: LLMClient, preferences: str, fan_out: bool = False) -> dict:
+    """Generate a validated week, one request or 7 concurrent ones; returns {"plan", "failed_days"}"""
+    if fan_out:
+        return await fan_out_week_plan(
+            lambda day, context: generate_validated(
+                llm, build_diet_day_prompt(preferences, day, context), DayPlan, "diet", key=day
+            ),
+            "name"
+        )
+    return await generate_validated_week(
+        llm, build_diet_prompt(preferences), lambda day: build_diet_day_prompt(preferences, day), DayPlan, "diet"
+    )
+
+async def generate_validated_diet_week(llm: LLMClient, preferences: str) -> dict:
+    """Generate a complete, validated week (used to stock the plan pool)"""
+    result = await generate_diet_week(llm, preferences)
+    if result["failed_days"]:
+        raise ValueError(f"no valid plan for {', '.join(result['failed_days'])}")
+    return result["plan"]
+
+register_generator("diet", generate_validated_diet_week)
+
+@router.post("/generate", dependencies=[Depends(deadline("plan"))])
+async def generate_diet_plan(request: GenerateDietRequest, llm: LLMClient = Depends(get_llm)):
+    """Generate a personalized diet plan using Gemini AI"""
+    try:
+        # Serve a pre-generated plan for common preferences, then the cache, then Gemini
+        failed_days = []
+        diet_plan = await take_plan("diet", request.preferences)
+        if diet_plan is None:
+            diet_plan = response_cache.get("diet", llm.model_name, request.preferences)
+        if diet_plan is None:
+            # Every day is validated; broken days are repaired or regenerated on their own.
+            # Identical requests arriving meanwhile share this generation
+            result = await llm_flights.run(
+                "diet", lambda: generate_diet_week(llm, request.preferences, request.fan_out),
+                llm.model_name, request.preferences, request.fan_out
+            )
+            diet_plan, failed_days = result["plan"], result["failed_days"]
+            if not diet_plan:
+                raise HTTPException(status_code=500, detail="Failed to generate diet plan")
+            if not failed_days:
+                response_cache.set("diet", diet_plan, llm.model_name, request.preferences)
+        
+        return {"success": not failed_days, "diet_plan": diet_plan, "failed_days": failed_days}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/generate/stream", dependencies=[Depends(deadline("plan"))])
+async def generate_diet_plan_stream(request: GenerateDietRequest, llm: LLMClient = Depends(get_llm)):
+    """Stream a generated diet plan day by day as Server-Sent Events, saving each day as it arrives"""
+
+    def validate_day(value: dict) -> dict:
+        return DayPlan(**value).model_dump()
+
+    async def save_day(day: str, day_plan: dict):
+        async with AsyncSessionLocal() as db:
+            await replace_diet_rows(
+                db, request.user_id, diet_rows(request.user_id, day, DayPlan(**day_plan)), DietPlan.day == day
+            )
+
+    async def events():
+        try:
+            async for event in stream_week_plan(
+                llm,
+                build_diet_prompt(request.preferences),
+                lambda day: build_diet_day_prompt(request.preferences, day),
+                validate_day,
+                save_day
+            ):
+                if event.get("done"):
+                    yield sse_event({"done": True, "success": not event["failed_days"],
+                                     "diet_plan": event["plan"], "failed_days": event["failed_days"]})
+                else:
+                    yield sse_event({"day": event["day"], "plan": event["plan"]})
+        except Exception as e:
+            yield sse_event({"detail": str(e), "status_code": 500}, event="error")
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.post("/save")
+async def save_diet_meal(meal: SaveDietRequest, db: AsyncSession = Depends(get_db)):
+    """Save a single meal to the database"""
+    try:
+        diet_entry = DietPlan(
+            user_id=meal.user_id,
+            day=meal.day,
+            meal_type=meal.meal_type,
+            meal_name=meal.meal_name,
+            calories=meal.calories,
+            protein=meal.protein,
+            carbs=meal.carbs,
+            fat=meal.fat
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Lock the plan document first, as replace_plan_rows does, so concurrent
+    # changes to this user's plan apply one after another
+    await lock_document(db, meal.user_id, "diet")
+    db.add(diet_entry)
+    await db.flush()
+    await refresh_diet_document(db, meal.user_id)
+    await db.commit()
+    return {"success": True, "id": diet_entry.id}
+
+@router.post("/save-plan")
+async def save_diet_plan(request: SaveDietPlanRequest, db: AsyncSession = Depends(get_db)):
+    """Replace a user's diet plan with a whole week in a single transaction
+
+    A partial week (e.g. a generation with failed days) only replaces the days
+    it contains, so the saved plan keeps the others; an empty one clears the plan.
+    """
+    # Days are checked before anything is written; the meals were validated by DayPlan
+    try:
+        diet_plan = {DayName.canonical(day): day_plan for day, day_plan in request.diet_plan.items()}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    rows = [
+        row
+        for day, day_plan in diet_plan.items()
+        for row in diet_rows(request.user_id, day, day_plan)
+    ]
+
+    where = [DietPlan.day.in_(list(diet_plan))] if 0 < len(diet_plan) < len(DAYS) else []
+    doc = await replace_diet_rows(db, request.user_id, rows, *where, expected_version=request.expected_version)
+    return {"success": True, "saved_count": len(rows), "version": doc.version if doc else 0}
+
+@router.get("/{user_id}")
+async def get_diet_plan(user_id: int, if_none_match: Optional[str] = Header(None), db: AsyncSession = Depends(get_db)):
+    """Retrieve diet plan for a user"""
+    doc = await get_document(db, user_id, "diet")
+    if doc is None:
+        # Plans saved before documents existed are assembled once and stored
+        doc = await backfill_document(db, user_id, "diet", refresh_diet_document)
+        if doc is None:
+            return {"success": False, "message": "No diet plan found"}
     
-    return {"success": True, "diet_plan": diet_plan}
+    return document_response("diet_plan", doc, if_none_match)
+
+async def load_diet_week(user_id: int) -> dict:
+    return await read_document(user_id, "diet")
+
+@router.get("/{user_id}/{day}")
+async def get_diet_day(user_id: int, day: str, db: AsyncSession = Depends(get_db)):
+    """Retrieve one day of a user's diet plan"""
+    day = slot_name(DayName, day)
+    meals = (await db.scalars(
+        select(DietPlan).where(DietPlan.user_id == user_id, DietPlan.day == day).order_by(DietPlan.id)
+    )).all()
+    if not meals:
+        return {"success": False, "message": f"No diet plan found for {day}"}
+    return {"success": True, "day": day, "plan": group_diet_rows(meals)[day]}
+
+@router.get("/{user_id}/{day}/{meal_type}")
+async def get_diet_meal(user_id: int, day: str, meal_type: str, db: AsyncSession = Depends(get_db)):
+    """Retrieve one meal slot of a user's diet plan"""
+    day, meal_type = slot_name(DayName, day), slot_name(MealTypeName, meal_type)
+    meals = (await db.scalars(
+        select(DietPlan)
+        .where(DietPlan.user_id == user_id, DietPlan.day == day, DietPlan.meal_type == meal_type)
+        .order_by(DietPlan.id)
+    )).all()
+    if not meals:
+        return {"success": False, "message": f"No {meal_type} found for {day}"}
+    return {"success": True, "day": day, "meal_type": meal_type, "meals": group_diet_rows(meals)[day][meal_type]}
+
+@router.post("/{user_id}/{day}/regenerate", dependencies=[Depends(deadline("plan"))])
+async def regenerate_diet_day(user_id: int, day: str, request: RegenerateDietRequest, db: AsyncSession = Depends(get_db), llm: LLMClient = Depends(get_llm)):
+    """Regenerate one day of a saved plan, with the rest of the week as context"""
+    day = slot_name(DayName, day)
+    week = await load_diet_week(user_id)
+    day_plan = await generate_validated(
+        llm, build_diet_day_prompt(request.preferences, day, summarize_week(week, "name", skip_day=day)),
+        DayPlan, "diet", key=day
+    )
+    if day_plan is None:
+        raise HTTPException(status_code=500, detail="Failed to parse AI response")
+
+    await replace_diet_rows(db, user_id, diet_rows(user_id, day, DayPlan(**day_plan)), DietPlan.day == day)
+    return {"success": True, "day": day, "plan": day_plan}
+
+@router.post("/{user_id}/{day}/{meal_type}/regenerate", dependencies=[Depends(deadline("plan"))])
+async def regenerate_diet_meal(user_id: int, day: str, meal_type: str, request: RegenerateDietRequest, db: AsyncSession = Depends(get_db), llm: LLMClient = Depends(get_llm)):
+    """Regenerate one meal slot of a saved plan, with the rest of the week as context"""
+    day, meal_type = slot_name(DayName, day), slot_name(MealTypeName, meal_type)
+    week = await load_diet_week(user_id)
+    current = [item["name"] for item in week.get(day, {}).get(meal_type, [])]
+    meals = await generate_validated_list(
+        llm, build_diet_slot_prompt(request.preferences, day, meal_type, len(current) or 2, summarize_week(week, "name"), current),
+        MealItem, "diet", key=meal_type
+    )
+    if meals is None:
+        raise HTTPException(status_code=500, detail="Failed to parse AI response")
+
+    await replace_diet_rows(
+        db, user_id, meal_rows(user_id, day, meal_type, [MealItem(**meal) for meal in meals]),
+        DietPlan.day == day, DietPlan.meal_type == meal_type
+    )
+    return {"success": True, "day": day, "meal_type": meal_type, "meals": meals}
 
 @router.delete("/{user_id}")
-def delete_diet_plan(user_id: int, db: Session = Depends(get_db)):
+async def delete_diet_plan(user_id: int, db: AsyncSession = Depends(get_db)):
     """Delete all diet plan entries for a user"""
-    db.query(DietPlan).filter(DietPlan.user_id == user_id).delete()
-    db.commit()
+    await replace_diet_rows(db, user_id, [])
     return {"success": True, "message": "Diet plan deleted"}
@@ -1,29 +1,24 @@
-from fastapi import APIRouter, HTTPException, Depends
-from sqlalchemy.orm import Session
-from database import SessionLocal
-from models import ExercisePlan
+from fastapi import APIRouter, HTTPException, Depends, Header
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal, get_db
+from models import ExercisePlan, DayName, ExerciseCategoryName
 from pydantic import BaseModel
 from typing import List, Optional
-import google.generativeai as genai
-import os
-from dotenv import load_dotenv
-import json
-
-load_dotenv()
+from llm import LLMClient, get_llm
+from resilience import deadline
+from singleflight import llm_flights
+from cache import response_cache
+from streaming import sse_event, stream_week_plan, fan_out_week_plan
+from plan_pool import register_generator, take_plan
+from plan_documents import backfill_document, document_response, get_document, read_document, write_document, slot_name, summarize_week
+from plan_service import replace_plan_rows
+from structured import generate_validated, generate_validated_list, generate_validated_week
+from telemetry import get_logger
 
 router = APIRouter(prefix="/exercise", tags=["exercise"])
-
-# Configure Gemini API
-GEMINI_API_KEY = os.getenv("GEMINIAPI")
-genai.configure(api_key=GEMINI_API_KEY)
-
-# Dependency: get DB session
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+log = get_logger("exercise")
 
 # Pydantic models
 class ExerciseItem(BaseModel):
@@ -33,19 +28,22 @@ class ExerciseItem(BaseModel):
     sets: Optional[int] = None
     reps: Optional[int] = None
 
+class ExerciseDayPlan(BaseModel):
+    Cardio: List[ExerciseItem]
+    Strength: List[ExerciseItem]
+    Flexibility: List[ExerciseItem]
+
 class GenerateExerciseRequest(BaseModel):
     user_id: int
     preferences: str = ""  # e.g., "beginner, no equipment"
+    fan_out: bool = False  # generate the 7 days as concurrent single-day requests
 
-@router.post("/generate")
-async def generate_exercise_plan(request: GenerateExerciseRequest, db: Session = Depends(get_db)):
-    """Generate a personalized exercise plan using Gemini AI"""
-    if not GEMINI_API_KEY:
-        raise HTTPException(status_code=500, detail="Gemini API key not configured")
-    
-    try:
-        prompt = f"""Generate a comprehensive 7-day exercise plan for one week (Monday to Sunday).
-        User preferences: {request.preferences if request.preferences else 'Balanced workout for general fitness'}
+class RegenerateExerciseRequest(BaseModel):
+    preferences: str = ""
+
+def build_exercise_prompt(preferences: str) -> str:
+    return f"""Generate a comprehensive 7-day exercise plan for one week (Monday to Sunday).
+        User preferences: {preferences if preferences else 'Balanced workout for general fitness'}
         
         For each day, provide exercises in these categories:
         - Cardio: 2 exercises
@@ -78,87 +76,83 @@ async def generate_exercise_plan(request: GenerateExerciseRequest, db: Session =
         }}
         
         Make exercises realistic and achievable. Vary the exercises across the week."""
+
+def build_exercise_day_prompt(preferences: str, day: str, week_context: str = "") -> str:
+    context = f"\n        Rest of the week (use different exercises):\n{week_context}\n" if week_context else ""
+    return f"""Generate an exercise plan for {day}.
+        User preferences: {preferences if preferences else 'Balanced workout for general fitness'}
+        {context}
+        
+        Provide exercises in these categories:
+        - Cardio: 2 exercises
+        - Strength: 2 exercises
+        - Flexibility: 1 exercise
+        
+        For each exercise, include:
+        - exercise_name: name of the exercise
+        - duration: time in minutes
+        - calories: estimated calories burned
+        - sets: number of sets (for strength exercises, null for others)
+        - reps: repetitions per set (for strength exercises, null for others)
         
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(prompt)
+        Return ONLY valid JSON in this exact format:
+        {{
+            "Cardio": [
+                {{"exercise_name": "Running", "duration": 20, "calories": 200, "sets": null, "reps": null}},
+                {{"exercise_name": "Jump Rope", "duration": 10, "calories": 100, "sets": null, "reps": null}}
+            ],
+            "Strength": [
+                {{"exercise_name": "Push-ups", "duration": 10, "calories": 50, "sets": 3, "reps": 15}},
+                {{"exercise_name": "Squats", "duration": 10, "calories": 60, "sets": 3, "reps": 20}}
+            ],
+            "Flexibility": [
+                {{"exercise_name": "Yoga Stretches", "duration": 15, "calories": 30, "sets": null, "reps": null}}
+            ]
+        }}
         
-        # Log raw response for debugging
-        print("="*50)
-        print("RAW GEMINI RESPONSE:")
-        print(response.text)
-        print("="*50)
+        Make exercises realistic and achievable."""
+
+def build_exercise_slot_prompt(preferences: str, day: str, category: str, count: int, week_context: str, current: List[str]) -> str:
+    return f"""Replace the {category} exercises for {day} in a weekly exercise plan.
+        User preferences: {preferences if preferences else 'Balanced workout for general fitness'}
         
-        # Parse the response
-        response_text = response.text.strip()
-        # Remove markdown code blocks if present
-        if response_text.startswith("```"):
-            response_text = response_text.split("```")[1]
-            if response_text.startswith("json"):
-                response_text = response_text[4:]
-            response_text = response_text.strip()
+        Current week plan:
+{week_context}
         
-        print("CLEANED RESPONSE:")
-        print(response_text[:500])  # Print first 500 chars
-        print("="*50)
+        Do not reuse the current {day} {category} exercises: {', '.join(current) if current else 'None'}
         
-        try:
-            exercise_plan = json.loads(response_text)
-        except json.JSONDecodeError as json_err:
-            print(f"JSON Parse Error: {json_err}")
-            print(f"Attempted to parse: {response_text[:200]}")
-            raise HTTPException(
-                status_code=500, 
-                detail=f"Failed to parse AI response as JSON. AI returned invalid format. Error: {str(json_err)}"
-            )
+        Provide {count} new {category} exercises that fit with the rest of the week.
+        For each exercise, include:
+        - exercise_name: name of the exercise
+        - duration: time in minutes
+        - calories: estimated calories burned
+        - sets: number of sets (for strength exercises, null for others)
+        - reps: repetitions per set (for strength exercises, null for others)
         
-        # Validate structure
-        if not isinstance(exercise_plan, dict):
-            raise HTTPException(status_code=500, detail="AI response is not a valid exercise plan structure")
-        
-        # Delete old plan for this user
-        db.query(ExercisePlan).filter(ExercisePlan.user_id == request.user_id).delete()
-        db.commit()
-        
-        # Save new plan to database
-        saved_count = 0
-        for day, categories in exercise_plan.items():
-            for category, exercises in categories.items():
-                for exercise in exercises:
-                    exercise_entry = ExercisePlan(
-                        user_id=request.user_id,
-                        day=day,
-                        category=category,
-                        exercise_name=exercise["exercise_name"],
-                        duration=exercise["duration"],
-                        calories=exercise["calories"],
-                        sets=exercise.get("sets"),
-                        reps=exercise.get("reps")
-                    )
-                    db.add(exercise_entry)
-                    saved_count += 1
-        db.commit()
-        
-        print(f"✅ Saved {saved_count} exercises to database for user {request.user_id}")
-        
-        return {"success": True, "exercise_plan": exercise_plan, "saved_count": saved_count}
-    except json.JSONDecodeError as e:
-        print(f"❌ JSON Decode Error: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Failed to parse AI response: {str(e)}")
-    except Exception as e:
-        print(f"❌ General Error: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Error generating exercise plan: {str(e)}")
+        Return ONLY valid JSON in this exact format:
+        [{{"exercise_name": "Push-ups", "duration": 10, "calories": 50, "sets": 3, "reps": 15}}, ...]
+        
+        Make exercises realistic and achievable."""
 
-@router.get("/{user_id}")
-def get_exercise_plan(user_id: int, db: Session = Depends(get_db)):
-    """Retrieve exercise plan for a user"""
-    exercises = db.query(ExercisePlan).filter(ExercisePlan.user_id == user_id).all()
-    
-    if not exercises:
-        return {"success": False, "message": "No exercise plan found"}
-    
-    # Group exercises by day and category
+def exercise_rows(user_id: int, day: str, day_plan: dict) -> List[dict]:
+    """Flatten one day of a plan into exercise_plans rows"""
+    return [
+        {
+            "user_id": user_id,
+            "day": day,
+            "category": category,
+            "exercise_name": exercise["exercise_name"],
+            "duration": exercise["duration"],
+            "calories": exercise["calories"],
+            "sets": exercise.get("sets"),
+            "reps": exercise.get("reps")
+        }
+        for category, exercises in day_plan.items()
+        for exercise in exercises
+    ]
+
+def group_exercise_rows(exercises: List[ExercisePlan]) -> dict:
+    """Group exercises by day and category"""
     exercise_plan = {}
     for exercise in exercises:
         if exercise.day not in exercise_plan:
@@ -171,12 +165,203 @@ def get_exercise_plan(user_id: int, db: Session = Depends(get_db)):
             "sets": exercise.sets,
             "reps": exercise.reps
         })
+    return exercise_plan
+
+async def refresh_exercise_document(db: AsyncSession, user_id: int):
+    """Rebuild the stored plan document from the user's rows; the caller commits"""
+    exercises = (await db.scalars(
+        select(ExercisePlan).where(ExercisePlan.user_id == user_id).order_by(ExercisePlan.day, ExercisePlan.id)
+    )).all()
+    return await write_document(db, user_id, "exercise", group_exercise_rows(exercises))
+
+async def replace_exercise_rows(db: AsyncSession, user_id: int, rows: List[dict], *where, expected_version: Optional[int] = None):
+    """Atomically swap the user's rows matching where (all rows if none) for rows"""
+    return await replace_plan_rows(
+        db, ExercisePlan, "exercise", user_id, rows, refresh_exercise_document, *where, expected_version=expected_version
+    )
+
+async def generate_exercise_week(llm: LLMClient, preferences: str, fan_out: bool = False) -> dict:
+    """Generate a validated week, one request or 7 concurrent ones; returns {"plan", "failed_days"}"""
+    if fan_out:
+        return await fan_out_week_plan(
+            lambda day, context: generate_validated(
+                llm, build_exercise_day_prompt(preferences, day, context), ExerciseDayPlan, "exercise", key=day
+            ),
+            "exercise_name"
+        )
+    return await generate_validated_week(
+        llm, build_exercise_prompt(preferences), lambda day: build_exercise_day_prompt(preferences, day),
+        ExerciseDayPlan, "exercise"
+    )
+
+async def generate_validated_exercise_week(llm: LLMClient, preferences: str) -> dict:
+    """Generate a complete, validated week (used to stock the plan pool)"""
+    result = await generate_exercise_week(llm, preferences)
+    if result["failed_days"]:
+        raise ValueError(f"no valid plan for {', '.join(result['failed_days'])}")
+    return result["plan"]
+
+register_generator("exercise", generate_validated_exercise_week)
+
+@router.post("/generate", dependencies=[Depends(deadline("plan"))])
+async def generate_exercise_plan(request: GenerateExerciseRequest, db: AsyncSession = Depends(get_db), llm: LLMClient = Depends(get_llm)):
+    """Generate a personalized exercise plan using Gemini AI"""
+    try:
+        # Serve a pre-generated plan for common preferences, then the cache, then Gemini
+        failed_days = []
+        exercise_plan = await take_plan("exercise", request.preferences)
+        if exercise_plan is None:
+            exercise_plan = response_cache.get("exercise", llm.model_name, request.preferences)
+        if exercise_plan is None:
+            # Every day is validated before the saved plan is touched; broken
+            # days are repaired or regenerated on their own. Identical requests
+            # arriving meanwhile share this generation
+            result = await llm_flights.run(
+                "exercise", lambda: generate_exercise_week(llm, request.preferences, request.fan_out),
+                llm.model_name, request.preferences, request.fan_out
+            )
+            exercise_plan, failed_days = result["plan"], result["failed_days"]
+            if not exercise_plan:
+                raise HTTPException(status_code=500, detail="Failed to generate exercise plan")
+            if failed_days:
+                log.warning("No valid exercise plan", extra={"failed_days": failed_days})
+            else:
+                response_cache.set("exercise", exercise_plan, llm.model_name, request.preferences)
+        
+        # Replace the user's plan in one transaction. For a partial week only the
+        # generated days are replaced, so the saved plan keeps its failed days
+        rows = [
+            row
+            for day, day_plan in exercise_plan.items()
+            for row in exercise_rows(request.user_id, day, day_plan)
+        ]
+        where = [ExercisePlan.day.in_(list(exercise_plan))] if failed_days else []
+        doc = await replace_exercise_rows(db, request.user_id, rows, *where)
+        
+        log.info("Saved exercise plan", extra={"user_id": request.user_id, "saved_count": len(rows)})
+        
+        return {"success": not failed_days, "exercise_plan": exercise_plan, "saved_count": len(rows),
+                "failed_days": failed_days, "version": doc.version if doc else 0}
+    except HTTPException:
+        raise
+    except Exception as e:
+        log.exception("Exercise plan generation failed")
+        raise HTTPException(status_code=500, detail=f"Error generating exercise plan: {str(e)}")
+
+@router.post("/generate/stream", dependencies=[Depends(deadline("plan"))])
+async def generate_exercise_plan_stream(request: GenerateExerciseRequest, llm: LLMClient = Depends(get_llm)):
+    """Stream a generated exercise plan day by day as Server-Sent Events, saving each day as it arrives"""
+
+    def validate_day(value: dict) -> dict:
+        return ExerciseDayPlan(**value).model_dump()
+
+    async def save_day(day: str, day_plan: dict):
+        async with AsyncSessionLocal() as db:
+            await replace_exercise_rows(
+                db, request.user_id, exercise_rows(request.user_id, day, day_plan), ExercisePlan.day == day
+            )
+
+    async def events():
+        try:
+            async for event in stream_week_plan(
+                llm,
+                build_exercise_prompt(request.preferences),
+                lambda day: build_exercise_day_prompt(request.preferences, day),
+                validate_day,
+                save_day
+            ):
+                if event.get("done"):
+                    yield sse_event({"done": True, "success": not event["failed_days"],
+                                     "exercise_plan": event["plan"], "failed_days": event["failed_days"]})
+                else:
+                    yield sse_event({"day": event["day"], "plan": event["plan"]})
+        except Exception as e:
+            yield sse_event({"detail": str(e), "status_code": 500}, event="error")
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.get("/{user_id}")
+async def get_exercise_plan(user_id: int, if_none_match: Optional[str] = Header(None), db: AsyncSession = Depends(get_db)):
+    """Retrieve exercise plan for a user"""
+    doc = await get_document(db, user_id, "exercise")
+    if doc is None:
+        # Plans saved before documents existed are assembled once and stored
+        doc = await backfill_document(db, user_id, "exercise", refresh_exercise_document)
+        if doc is None:
+            return {"success": False, "message": "No exercise plan found"}
     
-    return {"success": True, "exercise_plan": exercise_plan}
+    return document_response("exercise_plan", doc, if_none_match)
+
+async def load_exercise_week(user_id: int) -> dict:
+    return await read_document(user_id, "exercise")
+
+@router.get("/{user_id}/{day}")
+async def get_exercise_day(user_id: int, day: str, db: AsyncSession = Depends(get_db)):
+    """Retrieve one day of a user's exercise plan"""
+    day = slot_name(DayName, day)
+    exercises = (await db.scalars(
+        select(ExercisePlan).where(ExercisePlan.user_id == user_id, ExercisePlan.day == day).order_by(ExercisePlan.id)
+    )).all()
+    if not exercises:
+        return {"success": False, "message": f"No exercise plan found for {day}"}
+    return {"success": True, "day": day, "plan": group_exercise_rows(exercises)[day]}
+
+@router.get("/{user_id}/{day}/{category}")
+async def get_exercise_category(user_id: int, day: str, category: str, db: AsyncSession = Depends(get_db)):
+    """Retrieve one category of a day in a user's exercise plan"""
+    day, category = slot_name(DayName, day), slot_name(ExerciseCategoryName, category)
+    exercises = (await db.scalars(
+        select(ExercisePlan)
+        .where(ExercisePlan.user_id == user_id, ExercisePlan.day == day, ExercisePlan.category == category)
+        .order_by(ExercisePlan.id)
+    )).all()
+    if not exercises:
+        return {"success": False, "message": f"No {category} exercises found for {day}"}
+    return {"success": True, "day": day, "category": category,
+            "exercises": group_exercise_rows(exercises)[day][category]}
+
+@router.post("/{user_id}/{day}/regenerate", dependencies=[Depends(deadline("plan"))])
+async def regenerate_exercise_day(user_id: int, day: str, request: RegenerateExerciseRequest, db: AsyncSession = Depends(get_db), llm: LLMClient = Depends(get_llm)):
+    """Regenerate one day of a saved plan, with the rest of the week as context"""
+    day = slot_name(DayName, day)
+    week = await load_exercise_week(user_id)
+    day_plan = await generate_validated(
+        llm, build_exercise_day_prompt(request.preferences, day, summarize_week(week, "exercise_name", skip_day=day)),
+        ExerciseDayPlan, "exercise", key=day
+    )
+    if day_plan is None:
+        raise HTTPException(status_code=500, detail="Failed to parse AI response")
+
+    await replace_exercise_rows(db, user_id, exercise_rows(user_id, day, day_plan), ExercisePlan.day == day)
+    return {"success": True, "day": day, "plan": day_plan}
+
+@router.post("/{user_id}/{day}/{category}/regenerate", dependencies=[Depends(deadline("plan"))])
+async def regenerate_exercise_category(user_id: int, day: str, category: str, request: RegenerateExerciseRequest, db: AsyncSession = Depends(get_db), llm: LLMClient = Depends(get_llm)):
+    """Regenerate one category of a saved day, with the rest of the week as context"""
+    day, category = slot_name(DayName, day), slot_name(ExerciseCategoryName, category)
+    week = await load_exercise_week(user_id)
+    current = [item["exercise_name"] for item in week.get(day, {}).get(category, [])]
+    exercises = await generate_validated_list(
+        llm, build_exercise_slot_prompt(
+            request.preferences, day, category, len(current) or 2, summarize_week(week, "exercise_name"), current
+        ),
+        ExerciseItem, "exercise", key=category
+    )
+    if exercises is None:
+        raise HTTPException(status_code=500, detail="Failed to parse AI response")
+
+    await replace_exercise_rows(
+        db, user_id, exercise_rows(user_id, day, {category: exercises}),
+        ExercisePlan.day == day, ExercisePlan.category == category
+    )
+    return {"success": True, "day": day, "category": category, "exercises": exercises}
 
 @router.delete("/{user_id}")
-def delete_exercise_plan(user_id: int, db: Session = Depends(get_db)):
+async def delete_exercise_plan(user_id: int, db: AsyncSession = Depends(get_db)):
     """Delete all exercise plan entries for a user"""
-    db.query(ExercisePlan).filter(ExercisePlan.user_id == user_id).delete()
-    db.commit()
+    await replace_exercise_rows(db, user_id, [])
     return {"success": True, "message": "Exercise plan deleted"}
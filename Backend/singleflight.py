@@ -0,0 +1,58 @@
+import asyncio
+import math
+import threading
+from typing import Awaitable, Callable, Dict
+from fastapi import HTTPException
+from cache import ResponseCache
+from resilience import remaining
+from telemetry import llm_coalesced
+
+class SingleFlight:
+    """Share one in-flight generation between concurrent requests with the same normalized key
+
+    The first request for a key (the leader) starts the call as its own task;
+    requests arriving while it runs join it and get the same result or error.
+    The task is shielded, so a leader that disconnects does not cancel it for
+    the others, and each request still stops waiting at its own LLM deadline.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, asyncio.Task] = {}
+        self._counts: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def _count(self, namespace: str, role: str):
+        llm_coalesced.inc(namespace=namespace, role=role)
+        with self._lock:
+            counts = self._counts.setdefault(namespace, {"leader": 0, "coalesced": 0})
+            counts[role] += 1
+
+    def _finish(self, key: str, task: asyncio.Task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        if not task.cancelled():
+            task.exception()  # retrieved here in case every waiter gave up first
+
+    async def run(self, namespace: str, call: Callable[[], Awaitable], *parts):
+        """await call(), unless an identical (namespace, *parts) call is already running"""
+        key = ResponseCache.make_key(namespace, *parts)
+        task = self._flights.get(key)
+        if task is None:
+            self._count(namespace, "leader")
+            task = asyncio.ensure_future(call())
+            self._flights[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            self._count(namespace, "coalesced")
+        timeout = remaining()
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout=None if timeout == math.inf else max(timeout, 0))
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="AI service timed out")
+
+    def stats(self) -> dict:
+        with self._lock:
+            calls = {namespace: dict(counts) for namespace, counts in self._counts.items()}
+        return {"in_flight": len(self._flights), "calls": calls}
+
+llm_flights = SingleFlight()
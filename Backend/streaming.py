@@ -0,0 +1,272 @@
+import asyncio
+import json
+import os
+from typing import Awaitable, Callable, List, Optional, Tuple
+from fastapi import HTTPException
+from models import DAYS
+from plan_documents import summarize_week
+
+# How many single-day retries a broken or missing day gets after the week stream ends
+PLAN_DAY_RETRIES = int(os.getenv("PLAN_DAY_RETRIES", "2"))
+
+# Fan-out generation settings
+# PLAN_FANOUT_CONCURRENCY: single-day prompts in flight for one weekly plan
+# PLAN_VARIETY_MAX_DAYS: days the same item may appear on before the variety pass
+#   regenerates the later ones (0 disables the pass)
+PLAN_FANOUT_CONCURRENCY = int(os.getenv("PLAN_FANOUT_CONCURRENCY", "7"))
+PLAN_VARIETY_MAX_DAYS = int(os.getenv("PLAN_VARIETY_MAX_DAYS", "2"))
+
+def sse_event(data: dict, event: str = None) -> str:
+    """Format one Server-Sent Events message"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+def strip_code_fences(text: str) -> str:
+    """Remove markdown code blocks around an LLM JSON answer"""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("```")[1]
+        if text.startswith("json"):
+            text = text[4:]
+        text = text.strip()
+    return text
+
+class DayStreamParser:
+    """Incrementally pull complete top-level "Day": {...} entries out of a streamed JSON object
+
+    feed() returns (key, value) pairs as soon as each value is closed. A value
+    that is complete but not valid JSON comes back as (key, None) so the caller
+    can retry just that entry.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._started = False
+        self._finished = False
+
+    def feed(self, text: str) -> List[Tuple[str, Optional[dict]]]:
+        self._buffer += text
+        entries = []
+        while not self._finished:
+            entry = self._next_entry()
+            if entry is None:
+                break
+            entries.append(entry)
+        return entries
+
+    def _next_entry(self):
+        buf = self._buffer
+        pos = 0
+        if not self._started:
+            # Skip fences / prose before the outer object
+            pos = buf.find("{")
+            if pos == -1:
+                return None
+            self._started = True
+            pos += 1
+
+        while True:
+            # Anything that cannot start a key (whitespace, commas, stray text) is skipped
+            while pos < len(buf) and buf[pos] not in '"}':
+                pos += 1
+            if pos >= len(buf):
+                self._buffer = ""
+                return None
+            if buf[pos] == "}":
+                self._finished = True
+                return None
+
+            key_end = self._scan_string(buf, pos)
+            if key_end is None:
+                self._buffer = buf[pos:]
+                return None
+            colon = self._skip(buf, key_end, " \t\r\n")
+            if colon >= len(buf):
+                self._buffer = buf[pos:]
+                return None
+            value_start = self._skip(buf, colon + 1, " \t\r\n")
+            value_end = self._scan_value(buf, value_start)
+            if value_end is None:
+                self._buffer = buf[pos:]
+                return None
+
+            self._buffer = buf[value_end:]
+            try:
+                key = json.loads(buf[pos:key_end])
+            except json.JSONDecodeError:
+                buf, pos = self._buffer, 0
+                continue
+            try:
+                value = json.loads(buf[value_start:value_end])
+            except json.JSONDecodeError:
+                value = None
+            return key, value if isinstance(value, dict) else None
+
+    @staticmethod
+    def _skip(buf: str, pos: int, chars: str) -> int:
+        while pos < len(buf) and buf[pos] in chars:
+            pos += 1
+        return pos
+
+    @staticmethod
+    def _scan_string(buf: str, pos: int) -> Optional[int]:
+        """Return the index just past the string starting at pos, or None if incomplete"""
+        i = pos + 1
+        while i < len(buf):
+            if buf[i] == "\\":
+                i += 2
+                continue
+            if buf[i] == '"':
+                return i + 1
+            i += 1
+        return None
+
+    @classmethod
+    def _scan_value(cls, buf: str, pos: int) -> Optional[int]:
+        """Return the index just past the JSON value starting at pos, or None if incomplete"""
+        depth = 0
+        i = pos
+        while i < len(buf):
+            ch = buf[i]
+            if ch == '"':
+                end = cls._scan_string(buf, i)
+                if end is None:
+                    return None
+                i = end
+                if depth == 0:
+                    return i
+                continue
+            if ch in "{[":
+                depth += 1
+            elif ch in "}]":
+                if depth == 0:
+                    # End of the outer object after a bare value
+                    return i
+                depth -= 1
+                if depth == 0:
+                    return i + 1
+            elif ch == "," and depth == 0:
+                return i
+            i += 1
+        return None
+
+async def stream_week_plan(
+    llm,
+    week_prompt: str,
+    day_prompt: Callable[[str], str],
+    validate_day: Callable[[dict], dict],
+    save_day: Callable[[str, dict], Awaitable[None]],
+):
+    """Stream a weekly plan from the LLM, yielding each day as soon as it is complete
+
+    Every valid day is saved with save_day before it
+    is yielded. Days that come back malformed or never arrive are regenerated
+    one at a time with day_prompt instead of re-running the whole week.
+    Yields {"day", "plan"} events and finally {"done", "plan", "failed_days"}.
+    """
+    plan = {}
+
+    async def accept(day: str, value: Optional[dict]) -> Optional[dict]:
+        if day not in DAYS or day in plan or value is None:
+            return None
+        try:
+            day_plan = validate_day(value)
+        except Exception:
+            return None
+        await save_day(day, day_plan)
+        plan[day] = day_plan
+        return {"day": day, "plan": day_plan}
+
+    parser = DayStreamParser()
+    try:
+        async for text in llm.stream(week_prompt):
+            for day, value in parser.feed(text):
+                event = await accept(day, value)
+                if event:
+                    yield event
+    except HTTPException:
+        # Keep whatever days already arrived; the rest are retried below
+        pass
+
+    unavailable = False
+    for day in DAYS:
+        attempts = 0
+        while day not in plan and attempts < PLAN_DAY_RETRIES and not unavailable:
+            attempts += 1
+            try:
+                response = await llm.generate(day_prompt(day))
+                value = json.loads(strip_code_fences(response.text))
+            except HTTPException:
+                # The LLM is unavailable (already retried and fallen back): stop regenerating
+                unavailable = True
+                continue
+            except (json.JSONDecodeError, ValueError):
+                continue
+            if isinstance(value, dict) and day in value and isinstance(value[day], dict):
+                value = value[day]
+            event = await accept(day, value if isinstance(value, dict) else None)
+            if event:
+                yield event
+
+    yield {
+        "done": True,
+        "plan": {day: plan[day] for day in DAYS if day in plan},
+        "failed_days": [day for day in DAYS if day not in plan]
+    }
+
+def repeated_days(plan: dict, name_key: str) -> List[str]:
+    """Days holding an item already used on PLAN_VARIETY_MAX_DAYS earlier days"""
+    days_by_item = {}
+    for day in DAYS:
+        for items in plan.get(day, {}).values():
+            for item in items:
+                days_by_item.setdefault(item[name_key].strip().lower(), []).append(day)
+    crowded = set()
+    for days in days_by_item.values():
+        days = sorted(set(days), key=DAYS.index)
+        crowded.update(days[PLAN_VARIETY_MAX_DAYS:])
+    return [day for day in DAYS if day in crowded]
+
+async def fan_out_week_plan(
+    generate_day: Callable[[str, str], Awaitable[Optional[dict]]],
+    name_key: str,
+) -> dict:
+    """Generate a weekly plan as 7 concurrent single-day requests
+
+    generate_day(day, week_context) returns a validated day or None. After the first round,
+    days that repeat items from earlier days are regenerated once with the
+    rest of the week as context. Days that still fail are left out.
+    Once the LLM is unavailable (503/504) no more days are started, and the
+    error is raised if no day was generated. Returns {"plan", "failed_days"}.
+    """
+    semaphore = asyncio.Semaphore(PLAN_FANOUT_CONCURRENCY)
+    unavailable: List[HTTPException] = []
+
+    async def one_day(day: str, context: str = "") -> Optional[dict]:
+        async with semaphore:
+            if unavailable:
+                return None
+            try:
+                return await generate_day(day, context)
+            except HTTPException as e:
+                unavailable.append(e)
+                return None
+
+    results = await asyncio.gather(*(one_day(day) for day in DAYS))
+    plan = {day: day_plan for day, day_plan in zip(DAYS, results) if day_plan is not None}
+    if not plan and unavailable:
+        raise unavailable[-1]
+
+    if PLAN_VARIETY_MAX_DAYS > 0:
+        redo = repeated_days(plan, name_key)
+        results = await asyncio.gather(
+            *(one_day(day, summarize_week(plan, name_key, skip_day=day)) for day in redo)
+        )
+        for day, day_plan in zip(redo, results):
+            if day_plan is not None:
+                plan[day] = day_plan
+
+    return {
+        "plan": {day: plan[day] for day in DAYS if day in plan},
+        "failed_days": [day for day in DAYS if day not in plan]
+    }
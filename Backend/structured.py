@@ -0,0 +1,250 @@
+import asyncio
+import json
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Type
+from fastapi import HTTPException
+from google.api_core.exceptions import InvalidArgument
+from pydantic import BaseModel, ValidationError
+from streaming import DAYS, PLAN_DAY_RETRIES, DayStreamParser, strip_code_fences
+from telemetry import get_logger
+from dotenv import load_dotenv
+
+load_dotenv()
+
+log = get_logger("structured")
+
+# Structured output settings
+# LLM_STRUCTURED_OUTPUT: ask Gemini for JSON constrained to a response schema
+#   (falls back to plain prompting if the model rejects the schema)
+# LLM_REPAIR_ATTEMPTS: repair prompts for one invalid fragment before it is regenerated
+LLM_STRUCTURED_OUTPUT = os.getenv("LLM_STRUCTURED_OUTPUT", "1") == "1"
+LLM_REPAIR_ATTEMPTS = int(os.getenv("LLM_REPAIR_ATTEMPTS", "1"))
+
+class ParseStats:
+    """Per-kind counters for LLM answers that needed more than one parse"""
+
+    EVENTS = ("blocked", "invalid_json", "invalid_fragment", "repaired", "regenerated", "failed", "schema_rejected")
+
+    def __init__(self):
+        self._counts: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def count(self, kind: str, event: str, n: int = 1):
+        with self._lock:
+            counts = self._counts.setdefault(kind, dict.fromkeys(self.EVENTS, 0))
+            counts[event] += n
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {kind: dict(counts) for kind, counts in self._counts.items()}
+
+parse_stats = ParseStats()
+_schema_supported = LLM_STRUCTURED_OUTPUT
+
+def response_schema(model: Type[BaseModel]) -> dict:
+    """Translate a Pydantic model's JSON schema into the subset Gemini's response_schema accepts"""
+    schema = model.model_json_schema()
+    definitions = schema.pop("$defs", {})
+
+    def convert(node: dict) -> dict:
+        if "$ref" in node:
+            return convert(definitions[node["$ref"].split("/")[-1]])
+        if "anyOf" in node:
+            options = [option for option in node["anyOf"] if option.get("type") != "null"]
+            converted = convert(options[0])
+            if len(options) < len(node["anyOf"]):
+                converted["nullable"] = True
+            return converted
+        converted = {"type": node["type"]}
+        if node["type"] == "object":
+            converted["properties"] = {name: convert(value) for name, value in node.get("properties", {}).items()}
+            if node.get("required"):
+                converted["required"] = list(node["required"])
+        elif node["type"] == "array":
+            converted["items"] = convert(node["items"])
+        return converted
+
+    return convert(schema)
+
+def week_schema(day_model: Type[BaseModel]) -> dict:
+    day = response_schema(day_model)
+    return {"type": "object", "properties": {name: day for name in DAYS}, "required": list(DAYS)}
+
+def list_schema(item_model: Type[BaseModel]) -> dict:
+    return {"type": "array", "items": response_schema(item_model)}
+
+async def generate_text(llm, prompt: str, schema: dict, kind: str) -> str:
+    """Generate one JSON answer, schema-constrained when the model supports it
+
+    A blocked or empty answer is counted and returned as "", so callers retry
+    or regenerate it like any other unusable answer.
+    """
+    global _schema_supported
+    response = None
+    if _schema_supported:
+        try:
+            response = await llm.generate(prompt, generation_config={
+                "response_mime_type": "application/json",
+                "response_schema": schema,
+            })
+        except InvalidArgument as e:
+            # Older models reject response_schema; stop asking for it and prompt normally
+            log.warning("Structured output rejected, using plain prompts", extra={"error": str(e)})
+            parse_stats.count(kind, "schema_rejected")
+            _schema_supported = False
+    if response is None:
+        response = await llm.generate(prompt)
+    try:
+        return strip_code_fences(response.text)
+    except ValueError as e:
+        # response.text raises when the candidate was blocked (e.g. safety) or has no parts
+        log.warning("LLM returned no text", extra={"kind": kind, "error": str(e)})
+        parse_stats.count(kind, "blocked")
+        return ""
+
+async def generate_json(llm, prompt: str, schema: dict, kind: str):
+    """generate_text, parsed; json.JSONDecodeError is counted as invalid_json (unless blocked) and re-raised"""
+    text = await generate_text(llm, prompt, schema, kind)
+    if not text:
+        raise json.JSONDecodeError("Empty response", text, 0)
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        parse_stats.count(kind, "invalid_json")
+        raise
+
+def build_repair_prompt(fragment, error: ValidationError) -> str:
+    problems = "\n".join(
+        f"- {'.'.join(str(part) for part in item['loc']) or 'value'}: {item['msg']}" for item in error.errors()
+    )
+    return f"""This JSON does not match the required format:
+{json.dumps(fragment)}
+
+Problems:
+{problems}
+
+Return ONLY the corrected JSON, keeping every valid value unchanged."""
+
+async def validate_or_repair(llm, value, model: Type[BaseModel], kind: str, schema: Optional[dict] = None) -> Optional[dict]:
+    """Validate one fragment; if it is invalid, send only that fragment back for repair"""
+    try:
+        return model.model_validate(value).model_dump()
+    except ValidationError as e:
+        error = e
+    parse_stats.count(kind, "invalid_fragment")
+    schema = schema or response_schema(model)
+    for _ in range(LLM_REPAIR_ATTEMPTS):
+        try:
+            value = await generate_json(llm, build_repair_prompt(value, error), schema, kind)
+            repaired = model.model_validate(value).model_dump()
+        except ValidationError as e:
+            error = e
+            continue
+        except json.JSONDecodeError:
+            continue
+        parse_stats.count(kind, "repaired")
+        return repaired
+    return None
+
+async def generate_validated(llm, prompt: str, model: Type[BaseModel], kind: str, key: Optional[str] = None) -> Optional[dict]:
+    """One validated object (e.g. a day), repairing or regenerating it up to PLAN_DAY_RETRIES times
+
+    A {key: {...}} wrapper around the object is accepted. The 503/504 raised
+    when the LLM is unavailable propagates at once: llm.generate has already
+    retried and fallen back, so another attempt would only fail again.
+    """
+    schema = response_schema(model)
+    for attempt in range(1 + PLAN_DAY_RETRIES):
+        if attempt:
+            parse_stats.count(kind, "regenerated")
+        try:
+            value = await generate_json(llm, prompt, schema, kind)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(value, dict) and key in value and isinstance(value[key], dict):
+            value = value[key]
+        result = await validate_or_repair(llm, value, model, kind, schema)
+        if result is not None:
+            return result
+    parse_stats.count(kind, "failed")
+    return None
+
+async def generate_validated_list(llm, prompt: str, item_model: Type[BaseModel], kind: str, key: str) -> Optional[List[dict]]:
+    """A validated list of items (one meal slot or exercise category); a {key: [...]} wrapper is accepted
+
+    Like generate_validated, an unavailable LLM's 503/504 propagates.
+    """
+    schema = list_schema(item_model)
+    for attempt in range(1 + PLAN_DAY_RETRIES):
+        if attempt:
+            parse_stats.count(kind, "regenerated")
+        try:
+            items = await generate_json(llm, prompt, schema, kind)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(items, dict):
+            items = items.get(key)
+        if not isinstance(items, list):
+            parse_stats.count(kind, "invalid_fragment")
+            continue
+        # Only the items that fail validation are sent back for repair
+        results = await asyncio.gather(
+            *(validate_or_repair(llm, item, item_model, kind) for item in items)
+        )
+        if all(result is not None for result in results):
+            return list(results)
+    parse_stats.count(kind, "failed")
+    return None
+
+async def generate_validated_week(
+    llm,
+    week_prompt: str,
+    day_prompt: Callable[[str], str],
+    day_model: Type[BaseModel],
+    kind: str,
+) -> dict:
+    """A whole week in one request, validated day by day
+
+    Complete days are salvaged from malformed JSON, invalid days are repaired
+    on their own, and only days that are missing or beyond repair are
+    regenerated with day_prompt. Returns {"plan", "failed_days"}.
+
+    If the LLM is unavailable (503/504), no further days are regenerated, and
+    the error is raised when no day could be produced.
+    """
+    days = {}
+    text = await generate_text(llm, week_prompt, week_schema(day_model), kind)
+    if text:
+        try:
+            value = json.loads(text)
+            days = value if isinstance(value, dict) else {}
+        except json.JSONDecodeError:
+            # Keep every day that was complete before the JSON broke
+            parse_stats.count(kind, "invalid_json")
+            days = {day: value for day, value in DayStreamParser().feed(text) if value is not None}
+
+    day_schema = response_schema(day_model)
+    unavailable: List[HTTPException] = []
+
+    async def one_day(day: str) -> Optional[dict]:
+        try:
+            if isinstance(days.get(day), dict):
+                result = await validate_or_repair(llm, days[day], day_model, kind, day_schema)
+                if result is not None:
+                    return result
+            if unavailable:
+                return None
+            return await generate_validated(llm, day_prompt(day), day_model, kind, key=day)
+        except HTTPException as e:
+            unavailable.append(e)
+            return None
+
+    results = await asyncio.gather(*(one_day(day) for day in DAYS))
+    plan = {day: result for day, result in zip(DAYS, results) if result is not None}
+    if not plan and unavailable:
+        raise unavailable[-1]
+    return {
+        "plan": plan,
+        "failed_days": [day for day in DAYS if day not in plan]
+    }
@@ -0,0 +1,288 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, Iterable, Optional, Tuple
+from sqlalchemy import event
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Telemetry settings
+# LOG_LEVEL: minimum level written by the structured logger
+# LOG_FORMAT: "json" (one object per line) or "text"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+
+# Upper bounds (seconds) for the latency histograms
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+# ----------------------
+# Structured logging
+# ----------------------
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and any extra= fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_FIELDS})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+def setup_logging():
+    """Route the "medinova" loggers through a queue so handlers never write on the request path"""
+    global _listener
+    if _listener is not None:
+        return
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter() if LOG_FORMAT == "json"
+                        else logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    root = logging.getLogger("medinova")
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.propagate = False
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"medinova.{name}")
+
+setup_logging()
+
+# ----------------------
+# Metrics
+# ----------------------
+def _label_text(labels: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+    parts = [f'{key}="{value}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Histogram:
+    """Prometheus-style cumulative histogram with one series per label set"""
+
+    def __init__(self, name: str, help_text: str, buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = list(buckets)
+        self._series: Dict[tuple, list] = {}  # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ["+Inf"], series[:-1]):
+                    cumulative += count
+                    le = 'le="%s"' % bound
+                    lines.append(f"{self.name}_bucket{_label_text(labels, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_label_text(labels)} {series[-1]}")
+                lines.append(f"{self.name}_count{_label_text(labels)} {cumulative}")
+        return "\n".join(lines)
+
+class Counter:
+    """Prometheus-style counter with one series per label set"""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._series: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._series.items()):
+                lines.append(f"{self.name}{_label_text(labels)} {value}")
+        return "\n".join(lines)
+
+request_seconds = Histogram("http_request_duration_seconds", "Total request latency by route")
+request_db_seconds = Histogram("http_request_db_seconds", "Time spent in SQL statements per request")
+request_llm_seconds = Histogram("http_request_llm_seconds", "Time spent waiting on the LLM per request")
+db_statement_seconds = Histogram("db_statement_duration_seconds", "SQL statement latency by engine")
+llm_call_seconds = Histogram("llm_call_duration_seconds", "LLM call latency by model and outcome")
+llm_tokens = Counter("llm_tokens_total", "LLM tokens by route, model and direction (prompt/response)")
+llm_hedges = Counter("llm_hedges_total", "Hedged duplicate LLM requests by model (sent, and won by the duplicate)")
+llm_fallbacks = Counter("llm_fallbacks_total", "Answers served by the fallback model or the last-good-answer cache")
+llm_breaker_transitions = Counter("llm_breaker_transitions_total", "Circuit breaker state changes by model")
+llm_coalesced = Counter("llm_singleflight_total", "LLM generations by namespace: leader calls, and requests that joined one")
+admission_decisions = Counter("admission_decisions_total", "Admission outcomes by route class (admitted, rate_limited, shed)")
+admission_queue_seconds = Histogram("admission_queue_seconds", "Time admitted requests waited for a slot by route class")
+
+METRICS = [request_seconds, request_db_seconds, request_llm_seconds, db_statement_seconds, llm_call_seconds, llm_tokens,
+           llm_hedges, llm_fallbacks, llm_breaker_transitions, llm_coalesced, admission_decisions, admission_queue_seconds]
+
+# ----------------------
+# Per-request breakdown
+# ----------------------
+class RequestStats:
+    """Time and tokens one request spent outside its own code"""
+
+    __slots__ = ("scope", "db_seconds", "db_statements", "llm_seconds", "llm_calls", "prompt_tokens", "response_tokens")
+
+    def __init__(self, scope: dict):
+        self.scope = scope
+        self.db_seconds = 0.0
+        self.db_statements = 0
+        self.llm_seconds = 0.0
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        self.response_tokens = 0
+
+    @property
+    def route(self) -> str:
+        """Path template of the matched route (set by the router once it has matched)"""
+        return getattr(self.scope.get("route"), "path", None) or "unmatched"
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+def record_llm_call(model: str, seconds: float, outcome: str, prompt_tokens: int = 0, response_tokens: int = 0):
+    """Called by llm.py for every generation (streamed or not)"""
+    llm_call_seconds.observe(seconds, model=model, outcome=outcome)
+    stats = _current.get()
+    route = stats.route if stats else "background"
+    if prompt_tokens:
+        llm_tokens.inc(prompt_tokens, route=route, model=model, direction="prompt")
+    if response_tokens:
+        llm_tokens.inc(response_tokens, route=route, model=model, direction="response")
+    if stats:
+        stats.llm_seconds += seconds
+        stats.llm_calls += 1
+        stats.prompt_tokens += prompt_tokens
+        stats.response_tokens += response_tokens
+
+def instrument_engine(engine, name: str):
+    """Time every statement on a sync Engine (use async_engine.sync_engine for async ones)"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _start(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _end(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info["query_start"].pop()
+        db_statement_seconds.observe(seconds, engine=name)
+        stats = _current.get()
+        if stats:
+            stats.db_seconds += seconds
+            stats.db_statements += 1
+
+    @event.listens_for(engine, "handle_error")
+    def _error(exception_context):
+        starts = exception_context.connection.info.get("query_start") if exception_context.connection else None
+        if starts:
+            starts.pop()
+
+class MetricsMiddleware:
+    """ASGI middleware: per-route latency with DB/LLM breakdown, plus one access log line
+
+    Timing stops when the last body chunk is sent, so streamed responses
+    are measured to the end of the stream.
+    """
+
+    def __init__(self, app, skip_paths: Iterable[str] = ("/metrics",)):
+        self.app = app
+        self.skip_paths = set(skip_paths)
+        self.log = get_logger("access")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope)
+        token = _current.set(stats)
+        start = time.perf_counter()
+        status = 500
+        finished = False
+
+        def finish():
+            nonlocal finished
+            if finished:
+                return
+            finished = True
+            elapsed = time.perf_counter() - start
+            labels = {"route": stats.route, "method": scope["method"]}
+            request_seconds.observe(elapsed, status=str(status), **labels)
+            request_db_seconds.observe(stats.db_seconds, **labels)
+            request_llm_seconds.observe(stats.llm_seconds, **labels)
+            self.log.info("request", extra={
+                "method": scope["method"], "route": stats.route, "status": status,
+                "duration_ms": round(elapsed * 1000, 2),
+                "db_ms": round(stats.db_seconds * 1000, 2), "db_statements": stats.db_statements,
+                "llm_ms": round(stats.llm_seconds * 1000, 2), "llm_calls": stats.llm_calls,
+                "prompt_tokens": stats.prompt_tokens, "response_tokens": stats.response_tokens,
+            })
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                finish()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            finish()
+            _current.reset(token)
+
+def render_counters(name: str, help_text: str, values: Dict[tuple, float]) -> str:
+    """Counters kept elsewhere (label tuple -> value) in the exposition format"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+    lines += [f"{name}{_label_text(labels)} {value}" for labels, value in sorted(values.items())]
+    return "\n".join(lines)
+
+def render_pool_wait(snapshots: Dict[str, dict]) -> str:
+    """db_metrics.PoolMetrics checkout-wait histograms, one series per engine"""
+    name = "db_pool_checkout_wait_seconds"
+    lines = [f"# HELP {name} Time spent waiting for a pooled connection", f"# TYPE {name} histogram"]
+    for engine, snapshot in sorted(snapshots.items()):
+        labels = (("engine", engine),)
+        wait = snapshot["checkout_wait_seconds"]
+        for bound, cumulative in wait["buckets"].items():
+            le = 'le="%s"' % bound
+            lines.append(f"{name}_bucket{_label_text(labels, le)} {cumulative}")
+        lines.append(f"{name}_sum{_label_text(labels)} {wait['sum']}")
+        lines.append(f"{name}_count{_label_text(labels)} {wait['count']}")
+    return "\n".join(lines)
+
+def render_metrics(extra: Iterable[str] = ()) -> str:
+    """All registered metrics in the Prometheus text exposition format"""
+    return "\n\n".join([metric.render() for metric in METRICS] + list(extra)) + "\n"
@@ -7,8 +7,10 @@ load_dotenv()
 def test_chat():
     url = "http://127.0.0.1:8000/chat/"
     payload = {"message": "Hello, how are you?"}
+    # /chat/ needs a signed-in user: paste the access_token from /auth/login
+    headers = {"Authorization": f"Bearer {os.getenv('MEDINOVA_TOKEN', '')}"}
     try:
-        response = requests.post(url, json=payload)
+        response = requests.post(url, json=payload, headers=headers)
         print(f"Status Code: {response.status_code}")
         print(f"Response: {response.json()}")
     except Exception as e:
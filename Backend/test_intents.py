@@ -0,0 +1,41 @@
+import os
+import pytest
+
+# chat_router only needs these settings to import; nothing here touches the database or tokens
+os.environ.setdefault("NEONURL", "sqlite:///:memory:")
+os.environ.setdefault("JWT_SECRET_KEY", "test")
+
+from intents import same_words
+from routers.chat_router import intent_router
+
+def intent(message: str):
+    reply = intent_router.route(message)
+    return reply["intent"] if reply else None
+
+@pytest.mark.parametrize("message, expected", [
+    ("what can you do", "faq_capabilities"),
+    ("What can you do?", "faq_capabilities"),
+    ("how can I edit my profle", "faq_profile"),
+    ("are you a real doctor?", "faq_disclaimer"),
+    ("Is this medical advice", "faq_disclaimer"),
+])
+def test_faq_matches_near_exact_wording(message, expected):
+    assert intent(message) == expected
+
+@pytest.mark.parametrize("message", [
+    "how can you help me sleep",
+    "how can you help me lose weight",
+    "how do i update my diet",
+    "how do i update my medication",
+    "can you replace my inhaler",
+    "are you a dentist",
+    "who are u",
+])
+def test_near_miss_health_questions_are_not_faqs(message):
+    assert not (intent(message) or "").startswith("faq_")
+
+def test_same_words_allows_typos_and_fillers_only():
+    assert same_words("how can i edit my profle", "how can i edit my profile")
+    assert same_words("what can you do please", "what can you do")
+    assert not same_words("how can you help me sleep", "how can you help me")
+    assert not same_words("how do i update my diet", "how do i update my profile")
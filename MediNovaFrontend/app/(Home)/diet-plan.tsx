@@ -114,7 +114,9 @@ export default function DietPlanScreen() {
             });
             const data = await response.json();
 
-            if (data.success && data.diet_plan) {
+            // A partial week (success false, failed_days set) is still saved: save-plan
+            // only replaces the days it receives, so the saved plan keeps the rest
+            if (data.diet_plan && Object.keys(data.diet_plan).length) {
                 // Save the generated plan to database
                 await saveDietPlanToDatabase(uid, data.diet_plan);
                 setDietPlan(data.diet_plan);
@@ -126,27 +128,12 @@ export default function DietPlanScreen() {
 
     const saveDietPlanToDatabase = async (uid: number, plan: Record<string, DayPlan>) => {
         try {
-            // Save each meal to database
-            for (const [day, meals] of Object.entries(plan)) {
-                for (const [mealType, items] of Object.entries(meals)) {
-                    for (const item of items) {
-                        await fetch(`${API_URL}/diet/save`, {
-                            method: 'POST',
-                            headers: { 'Content-Type': 'application/json' },
-                            body: JSON.stringify({
-                                user_id: uid,
-                                day: day,
-                                meal_type: mealType,
-                                meal_name: item.name,
-                                calories: item.calories,
-                                protein: item.protein,
-                                carbs: item.carbs,
-                                fat: item.fat
-                            })
-                        });
-                    }
-                }
-            }
+            // Save the whole week in one request
+            await fetch(`${API_URL}/diet/save-plan`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ user_id: uid, diet_plan: plan })
+            });
             console.log('✅ Diet plan saved to database');
         } catch (error) {
             console.error('Error saving diet plan:', error);
@@ -156,14 +156,16 @@ export default function HomeScreen() {
         setIsLoading(true);
 
         try {
+            // The server keys chat memory on the signed-in user from the token
+            const token = await AsyncStorage.getItem('token');
             const response = await fetch(API_URL, {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    'Authorization': `Bearer ${token}`,
                 },
                 body: JSON.stringify({
-                    message: inputText,
-                    user_id: userId
+                    message: inputText
                 }),
             });
 